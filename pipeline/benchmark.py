@@ -0,0 +1,277 @@
+"""
+Benchmark of the calculation pipeline on synthetic EXIOBASE-shaped systems and LCI data, so that the
+performance can be measured and engine options compared without the EXIOBASE zips and LC-IMPACT workbooks.
+
+The stages of calculate-all.py are run one by one on the synthetic data and the wall time and peak RSS
+after each stage are written to a JSON report.
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import re
+import resource
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import pycountry as pyc
+import pymrio
+
+# regions of EXIOBASE 3, the last five are the rest of the world regions
+EXIOBASE_REGIONS = [
+    "AT", "BE", "BG", "CY", "CZ", "DE", "DK", "EE", "ES", "FI", "FR", "GR", "HR", "HU", "IE", "IT", "LT",
+    "LU", "LV", "MT", "NL", "PL", "PT", "RO", "SE", "SI", "SK", "GB", "US", "JP", "CN", "CA", "KR", "BR",
+    "IN", "MX", "RU", "AU", "CH", "TR", "TW", "NO", "ID", "ZA", "WA", "WL", "WE", "WF", "WM",
+]
+
+FINAL_DEMAND_CATEGORIES = [
+    "Final consumption expenditure by households",
+    "Final consumption expenditure by non-profit organisations serving households (NPISH)",
+    "Final consumption expenditure by government",
+    "Gross fixed capital formation",
+    "Changes in inventories",
+    "Changes in valuables",
+    "Exports: Total (fob)",
+]
+
+# (regions, sectors) of the synthetic systems
+SCALES = {
+    "small": (14, 20),
+    "medium": (49, 50),
+    "full": (49, 200),
+}
+
+
+def load_pipeline(path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "calculate-all.py")):
+    spec = importlib.util.spec_from_file_location("calculate_all", path)
+    pipeline = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(pipeline)
+    return pipeline
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def stressor_names(arguments):
+    """
+    Stressors of the synthetic satellite: the stressors of the impact categories and a stressor matching
+    each key of the grouping patterns.
+    """
+    names = [category["stressor"] for category in arguments["impact_categories"] if "grouping_pattern" not in category]
+    for grouping_pattern in arguments["exiobase_grouping_patterns"].values():
+        names += [re.sub(r"\.\*$", "", pattern) for pattern in grouping_pattern]
+    return list(dict.fromkeys(names))
+
+
+def synthetic_system(regions, n_sectors, stressors, seed):
+    """
+    IOSystem with the layout of an EXIOBASE 3 pxp system (Z, Y, x and a satellite with F and M) and random
+    values. Z has 5 % non-zero values and the output of every sector is at least 1.25 times its inputs,
+    so that I - A is invertible. Land and water stressors are non-zero for 10 % of the region-sectors.
+    """
+    rng = np.random.default_rng(seed)
+    index = pd.MultiIndex.from_product([regions, [f"Sector {i}" for i in range(n_sectors)]], names=["region", "sector"])
+    n = len(index)
+    Z = np.zeros((n, n))
+    for start in range(0, n, 1000):
+        block = rng.random((min(1000, n - start), n))
+        Z[start:start + 1000] = block * (block < 0.05)
+    demand = np.maximum(1.25 * Z.sum(axis=0) - Z.sum(axis=1), 0) + rng.random(n)
+    Y_columns = pd.MultiIndex.from_product([regions, FINAL_DEMAND_CATEGORIES], names=["region", "category"])
+    shares = rng.random((n, len(Y_columns)))
+    Y = demand[:, np.newaxis] * shares / shares.sum(axis=1, keepdims=True)
+    x = Z.sum(axis=1) + Y.sum(axis=1)
+
+    stressor_index = pd.Index(stressors, name="stressor")
+    density = np.array([0.1 if re.match("Land|Cropland|Permanent pastures|Forest|Other land|Water", s) else 0.6 for s in stressors])
+    F = rng.random((len(stressors), n)) * (rng.random((len(stressors), n)) < density[:, np.newaxis]) * 1e3
+    M = rng.random((len(stressors), n)) * 1e-2
+
+    system = pymrio.IOSystem(
+        Z=pd.DataFrame(Z, index=index, columns=index),
+        Y=pd.DataFrame(Y, index=index, columns=Y_columns),
+        x=pd.DataFrame(x, index=index, columns=["indout"]),
+        unit=pd.DataFrame({"unit": "M.EUR"}, index=index),
+        name=f"synthetic-{seed}",
+    )
+    system.satellite = pymrio.Extension(
+        "satellite",
+        F=pd.DataFrame(F, index=stressor_index, columns=index),
+        M=pd.DataFrame(M, index=stressor_index, columns=index),
+        unit=pd.DataFrame({"unit": "kg"}, index=stressor_index),
+    )
+    return system
+
+
+def synthetic_lci(arguments, regions, seed):
+    """
+    LCI datasets as returned by load_lci with the countries of pycountry (and the EXIOBASE regions) and random
+    CFs in the columns used by the impact categories.
+    """
+    rng = np.random.default_rng(seed)
+    countries = pd.DataFrame({"Country": [country.name for country in pyc.countries], "Country_Code": [country.alpha_2 for country in pyc.countries]})
+    # every EXIOBASE region is in the data, so no augmentation is needed
+    missing = [region for region in regions if region not in countries["Country_Code"].tolist() and region not in ["WA", "WL", "WE", "WF", "WM"]]
+    countries = pd.concat([countries, pd.DataFrame({"Country": missing, "Country_Code": missing})], ignore_index=True)
+
+    lci = {
+        "climate": pd.DataFrame({
+            "Substance": ["CO2", "CH4", "CH4 fossil", "N2O"],
+            "All effects 100yrs (terrestrial)": rng.random(4) * 1e-14,
+            "All effects 100yrs (aquatic)": rng.random(4) * 1e-15,
+        })
+    }
+    for category in arguments["impact_categories"]:
+        if category["lci"] not in lci:
+            lci[category["lci"]] = countries[["Country"]].copy()
+        lci[category["lci"]][category["cf"]] = rng.random(len(countries)) * 1e-13
+    for name in lci:
+        if name != "climate":
+            lci[name]["Country_Code"] = countries["Country_Code"]
+            lci[name]["Augmented"] = "original"
+    return lci
+
+
+def run_benchmark(pipeline, arguments, regions, n_sectors, solver="inverse", precision="float64", seed=0, verbose=False):
+    report = {
+        "regions": len(regions),
+        "sectors": n_sectors,
+        "solver": solver,
+        "precision": precision,
+        "stages": {},
+    }
+
+    def timed(stage, function, *args, **kwargs):
+        start = time.perf_counter()
+        with contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO()):
+            result = function(*args, **kwargs)
+        entry = report["stages"].setdefault(stage, {"seconds": 0.0, "calls": 0})
+        entry["seconds"] += time.perf_counter() - start
+        entry["calls"] += 1
+        entry["peak_rss_mb"] = peak_rss_mb()
+        return result
+
+    stressors = stressor_names(arguments)
+    exio3_19 = timed("synthetic_data", synthetic_system, regions, n_sectors, stressors, seed + 19)
+    exio3_11 = timed("synthetic_data", synthetic_system, regions, n_sectors, stressors, seed + 11)
+    lci_tables = timed("synthetic_data", synthetic_lci, arguments, regions, seed)
+
+    store, columns = timed("compile_lci", pipeline.compile_lci, lci_tables)
+    lci_datasets = timed("load_lci", pipeline.expand_lci, store, columns)
+
+    work_dir = tempfile.mkdtemp(prefix="pdf-benchmark-")
+    try:
+        cache_path = os.path.join(work_dir, "exiobase")
+        timed("save_exiobase_cache", pipeline.save_exiobase_cache, exio3_11, cache_path)
+        del exio3_11
+        exio3_11 = timed("load_exiobase_cache", pipeline.load_exiobase_cache, cache_path)
+
+        dtype = np.float32 if precision == "float32" else np.float64
+        if solver == "lu":
+            lu = timed("factorize_leontief", pipeline.factorize_leontief, exio3_11)
+            exio3_11.x_diag = timed("calc_x_diag", pipeline.calc_x_diag, exio3_11, lu=lu, dtype=dtype)
+            del lu
+        else:
+            exio3_11.A = timed("calc_A", pymrio.calc_A, exio3_11.Z, exio3_11.x)
+            exio3_11.L = timed("calc_L", pymrio.calc_L, exio3_11.A)
+            del exio3_11.A
+            L = timed("convert_L", pipeline.convert_leontief, exio3_11, dtype)
+            exio3_11.L = None
+            exio3_11.x_diag = timed("calc_x_diag", pipeline.calc_x_diag, exio3_11, L=L, dtype=dtype)
+            del L
+
+        exio_regions = exio3_19.get_regions()
+        consumption = pipeline.consumption_columns(exio3_11.x_diag.columns)
+        lcis = {}
+        for category in arguments["impact_categories"]:
+            if category["lci"] not in lcis:
+                lci, row_countries = timed("prepare_lci", pipeline.prepare_lci, category["lci"], lci_datasets[category["lci"]], exio_regions)
+                expansion = timed("region_expansion", pipeline.region_expansion, exio3_11.x_diag.index, exio3_11.x_diag.columns, arguments["row_region_mappings"], row_countries)
+                lcis[category["lci"]] = (lci, expansion)
+
+        satellites = {None: (exio3_11.satellite, exio3_19.satellite)}
+        stressors = {}
+        for category in arguments["impact_categories"]:
+            pattern = category.get("grouping_pattern")
+            if pattern not in satellites:
+                grouping_pattern = arguments["exiobase_grouping_patterns"][pattern]
+                satellites[pattern] = (timed("aggregate_satellite", pipeline.aggregate_satellite, exio3_11.satellite, grouping_pattern, pattern),
+                                       timed("aggregate_satellite", pipeline.aggregate_satellite, exio3_19.satellite, grouping_pattern, pattern))
+            stressors.setdefault((pattern, category["stressor"]), []).append(category)
+
+        # the stages of the calculation of the matrices (dr_s -> dr_u -> dr_f -> pdf) of each category
+        for (pattern, stressor_name), categories in stressors.items():
+            satellite_11, satellite_19 = satellites[pattern]
+            D_cba = timed("calculate_cba", pipeline.calculate_cba, exio3_11, satellite_11, stressor_name)
+            dr_s = timed("dr_s", pipeline.dr_s, D_cba)
+            del D_cba
+            for category in categories:
+                lci, expansion = lcis[category["lci"]]
+                dr_u = timed("dr_u", pipeline.dr_u, dr_s, expansion)
+                dr_f = timed("dr_f", pipeline.dr_f, satellite_19, dr_u, stressor_name)
+                del dr_u
+                timed("pdf", pipeline.pdf, lci, dr_f, category["cf"])
+                del dr_f
+            del dr_s
+
+        # the calculation of calculate-all.py, which does not build the matrices
+        pdfs = {}
+        stressors_by_pattern = {}
+        for (pattern, stressor_name), categories in stressors.items():
+            stressors_by_pattern.setdefault(pattern, {})[stressor_name] = categories
+        for pattern, pattern_stressors in stressors_by_pattern.items():
+            pdfs.update(timed("calculate_stressors", pipeline.calculate_stressors, pattern_stressors, lcis, consumption, exio3_11, *satellites[pattern]))
+
+        output_dir = os.path.join(work_dir, "output")
+        os.makedirs(output_dir)
+
+        def write_csv():
+            for name, result in pdfs.items():
+                pd.DataFrame(result).to_csv(os.path.join(output_dir, f"pdf-{name}.csv"), index=True)
+        timed("output_csv", write_csv)
+        if importlib.util.find_spec("pyarrow") is not None:
+            categories = {category["name"]: category["lci"] for category in arguments["impact_categories"]}
+            timed("output_parquet", pipeline.write_parquet, pdfs, categories, os.path.join(output_dir, "pdf-results.parquet"), {})
+    finally:
+        shutil.rmtree(work_dir)
+
+    report["total_seconds"] = sum(entry["seconds"] for stage, entry in report["stages"].items() if stage != "synthetic_data")
+    report["peak_rss_mb"] = peak_rss_mb()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the PDF calculation on synthetic EXIOBASE-shaped data.")
+    parser.add_argument("json_file", type=str, help="Path to the JSON file containing configuration parameters (impact categories, grouping patterns and row region mappings are used).")
+    parser.add_argument("--scale", choices=list(SCALES.keys()), default="full",
+                        help="Size of the synthetic systems: small (14 regions x 20 sectors), medium (49 x 50) or full (49 x 200, default).")
+    parser.add_argument("--solver", choices=["inverse", "lu"], default="inverse", help="Solver of the Leontief model (see calculate-all.py).")
+    parser.add_argument("--precision", choices=["float64", "float32"], default="float64", help="Precision of L·Y (see calculate-all.py).")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data (default 0).")
+    parser.add_argument("--report", type=str, default=None, help="Write the JSON report to this file instead of printing it.")
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the pipeline.")
+    args = parser.parse_args()
+
+    with open(args.json_file, "r") as f:
+        arguments = json.load(f)
+    n_regions, n_sectors = SCALES[args.scale]
+    # keep the rest of the world regions in the smaller scales
+    regions = EXIOBASE_REGIONS[:n_regions - 5] + EXIOBASE_REGIONS[-5:]
+
+    report = run_benchmark(load_pipeline(), arguments, regions, n_sectors, args.solver, args.precision, args.seed, args.verbose)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,11 +4,127 @@ import pandas as pd
 import pycountry as pyc
 import json
 import argparse
-
-def load_lci(lci_path):
+import os
+import hashlib
+import pickle
+import shutil
+import re
+import glob
+import threading
+import datetime
+import time
+import resource
+import contextlib
+import io
+import zipfile
+from collections import namedtuple
+from statistics import NormalDist
+
+# LC-IMPACT workbooks of each impact category, relative to lc_impact_path
+LCI_FILES = {
+    "climate": "2-climate change/Climate change CFs.xlsx",
+    "ozone": "5-photochemical ozone formation/Photochemical_Ozone_formation.xlsx",
+    "acidification": "7-terrestrial acidification/CF_terrestrial_acidification.xlsx",
+    "freshwater_eutrophication": "8-freshwater eutrophication/CF_FWEutrophication.xlsx",
+    "marine_eutrophication": "9-marine eutrophication/CFs_marine_eutrophication.xlsx",
+    "land": "11-Land stress/CFs_land_Use_average.xlsx",
+    "water": "12-water consumption/CFs_water_consumption_ecosystems_20180831.xlsx",
+}
+
+# bump when the way CFs are read from the workbooks changes to invalidate compiled CF stores
+LCI_STORE_VERSION = 2
+
+# custom mappings for countries that pycountry does not recognize
+# these should cover all the countries in the LCI data if country has alpha-2 code
+# these mappings were extracted manually
+EXTRA_COUNTRY_MAPPINGS = {
+    "Turkey": "TR",
+    "Russia": "RU",
+    "Bahamas, The": "BS",
+    "Bonaire": "BQ",
+    "Byelarus": "BY",
+    "Brunei": "BN",
+    "Cape Verde": "CV",
+    "Cocos Islands": "CC",
+    "Congo DRC": "CD",
+    "China, Hong Kong Special Administrative Region": "HK",
+    "Curacao": "CW",
+    "Democratic Republic of the Congo": "CD",
+    "Falkland Islands": "FK",
+    "Falkland Islands (Islas Malvinas)": "FK",
+    "Gambia, The": "GM",
+    "Gaza Strip": "PS",
+    "Heard Island & McDonald Islands": "HM",
+    "Ivory Coast": "CI",
+    "Macedonia": "MK",
+    "The Former Yugoslav Republic of Macedonia": "MK",
+    "Macau": "MO",
+    "Man, Isle of": "IM",
+    "Micronesia": "FM",
+    "Myanmar (Burma)": "MM",
+    "Netherlands Antilles": "AN",
+    "Palestinian Territory": "PS",
+    "Pacific Islands (Palau)": "PW",
+    "Pitcairn Islands": "PN",
+    "Reunion": "RE",
+    "Saba": "BQ",
+    "Saint Eustatius": "BQ",
+    "Saint Helena": "SH",
+    "Saint Martin": "MF",
+    "Sint Maarten": "SX",
+    "South Georgia and the South Sandwich Is": "GS",
+    "South Georgia": "GS",
+    "St. Helena": "SH",
+    "Saint Barthelemy": "BL",
+    "Saint Kitts and Nevis": "KN",
+    "St. Kitts and Nevis": "KN",
+    "St. Lucia": "LC",
+    "St. Pierre and Miquelon": "PM",
+    "Sao Tomo and Principe": "ST",
+    "St. Vincent and the Grenadines": "VC",
+    "Svalbard": "SJ",
+    "Jan Mayen": "SJ",
+    "Swaziland": "SZ",
+    "US Virgin Islands": "VI",
+    "Virgin Islands": "VG",
+    "Western Samoa": "WS",
+    "West Bank": "PS",
+}
+
+# country indexes built during this run, by key of the index
+COUNTRY_INDEXES = {}
+
+# aggregated satellites by (id of the satellite, grouping pattern), see aggregate_satellite
+AGGREGATED_SATELLITES = {}
+AGGREGATION_LOCK = threading.Lock()
+
+# records of the stages of the run when instrumentation is enabled, see enable_instrumentation and stage
+INSTRUMENTATION = None
+
+# hits and misses of the cached stages of the current run, see cache_event
+CACHE_EVENTS = []
+CACHE_EVENTS_LOCK = threading.Lock()
+
+# region codes of EXIOBASE 3.4 and older zips (ISO3 and WWx) and their codes in later versions, renamed like in
+# pymrio.parse_exiobase3 by read_exiobase_zip
+EXIOBASE_REGION_RENAMES = {
+    "AUS": "AU", "AUT": "AT", "BEL": "BE", "BGR": "BG", "BRA": "BR", "CAN": "CA", "CHE": "CH", "CHN": "CN",
+    "CYP": "CY", "CZE": "CZ", "DEU": "DE", "DNK": "DK", "ESP": "ES", "EST": "EE", "FIN": "FI", "FRA": "FR",
+    "GBR": "GB", "GRC": "GR", "HRV": "HR", "HUN": "HU", "IDN": "ID", "IND": "IN", "IRL": "IE", "ITA": "IT",
+    "JPN": "JP", "KOR": "KR", "LTU": "LT", "LUX": "LU", "LVA": "LV", "MEX": "MX", "MLT": "MT", "NLD": "NL",
+    "NOR": "NO", "POL": "PL", "PRT": "PT", "ROM": "RO", "RUS": "RU", "SVK": "SK", "SVN": "SI", "SWE": "SE",
+    "TUR": "TR", "TWN": "TW", "USA": "US", "ZAF": "ZA", "WWA": "WA", "WWE": "WE", "WWF": "WF", "WWL": "WL",
+    "WWM": "WM",
+}
+
+# rest of the world regions in EXIOBASE
+ROW_REGIONS = {"WA": "Asia and pacific", "WE": "Europe", "WF": "Africa", "WM": "Middle east", "WL": "America"}
+
+
+def read_lci_workbooks(lci_path, cache_dir=None):
     # for climate change 
     # TODO: check if it's correct to use 'all effects 100yrs'
-    lci_climate = pd.read_excel(f"{lci_path}/2-climate change/Climate change CFs.xlsx", 
+    lci_climate = pd.read_excel(f"{lci_path}/{LCI_FILES['climate']}", 
                                 sheet_name=" Characterization factors",
                                 header=[0,1])
     lci_climate = lci_climate.iloc[:4, [0, 6, 10]] # select 'substance', 'terrestrial all effects 100yrs', 'aquatic all effects 100yrs'
@@ -17,7 +133,7 @@ def load_lci(lci_path):
 
     # for photochemical ozone formation
     # this is clear, only one option for factors
-    lci_ozone = pd.read_excel(f"{lci_path}/5-photochemical ozone formation/Photochemical_Ozone_formation.xlsx",
+    lci_ozone = pd.read_excel(f"{lci_path}/{LCI_FILES['ozone']}",
                     sheet_name="CFs per country",
                     skiprows=0,
                     header=[0,1])
@@ -27,7 +143,7 @@ def load_lci(lci_path):
 
     # for terrestrial acidification
     # this is clear, only one option for factors
-    lci_acidification = pd.read_excel(f"{lci_path}/7-terrestrial acidification/CF_terrestrial_acidification.xlsx",
+    lci_acidification = pd.read_excel(f"{lci_path}/{LCI_FILES['acidification']}",
                     sheet_name="CF per countries",
                     skiprows=0,
                     header=[0,1],
@@ -38,7 +154,7 @@ def load_lci(lci_path):
 
     # for freshwater eutrophication
     # TODO: check if this average approach is correct
-    lci_freshwater_eutrophication = pd.read_excel(f"{lci_path}/8-freshwater eutrophication/CF_FWEutrophication.xlsx",
+    lci_freshwater_eutrophication = pd.read_excel(f"{lci_path}/{LCI_FILES['freshwater_eutrophication']}",
                     sheet_name="Country CFs")
     # take average of phosphorus emissions to water and soil
     lci_freshwater_eutrophication["Average"] = lci_freshwater_eutrophication[["CF for P emissions to water [PDFyr/kg]", "CF for P emissions to soil [PDFyr/kg]"]].mean(axis=1)
@@ -46,39 +162,54 @@ def load_lci(lci_path):
 
     # for marine eutrophication
     # TODO: check if selected columns below are correct, only direct N emissions to marine system are used?
-    lci_marine_eutrophication = pd.read_excel(f"{lci_path}/9-marine eutrophication/CFs_marine_eutrophication.xlsx",
+    lci_marine_eutrophication = pd.read_excel(f"{lci_path}/{LCI_FILES['marine_eutrophication']}",
                     sheet_name="country CFs")
     lci_marine_eutrophication = lci_marine_eutrophication[["Country.1", "CF for direct N emission to marine system [PDF*yr/kg]"]]
     lci_marine_eutrophication.rename(columns={lci_marine_eutrophication.columns[0]: "Country"}, inplace=True)
 
     # for land use 
     # TODO: should transformation be taken into account, now only occupation is used?
-    lci_land = pd.read_excel(f"{lci_path}/11-Land stress/CFs_land_Use_average.xlsx",
+    lci_land = pd.read_excel(f"{lci_path}/{LCI_FILES['land']}",
                     sheet_name="occupation average country",
                     skiprows=1,
                     header=[0,1])
     lci_land.columns = [' '.join(col).strip() for col in lci_land.columns]
     lci_land.rename(columns={lci_land.columns[0]: "Country"}, inplace=True)
-    lci_land = lci_land[["Country", "Annual crops Median", "Permanent crops Median", "Pasture Median", "Extensive forestry Median", "Intensive forestry Median", "Urban Median"]]
+    # the other percentiles of the land use types are kept for the uncertainty mode, see cf_percentiles
+    land_types = ["Annual crops", "Permanent crops", "Pasture", "Extensive forestry", "Intensive forestry", "Urban"]
+    land_percentiles = {land_type: [column[len(land_type) + 1:] for column in lci_land.columns
+                                    if column.startswith(land_type + " ") and percentile_of(column[len(land_type) + 1:]) not in (None, 50)]
+                        for land_type in land_types}
+    lci_land = lci_land[["Country", "Annual crops Median", "Permanent crops Median", "Pasture Median", "Extensive forestry Median", "Intensive forestry Median", "Urban Median",
+                         *[f"{land_type} {statistic}" for land_type in land_types for statistic in land_percentiles[land_type]]]]
     # Calculate the mean of forest land use types 
     lci_land["Forestry Median"] = lci_land[["Extensive forestry Median", "Intensive forestry Median"]].mean(axis=1)
-    lci_land = lci_land[["Country", "Annual crops Median", "Permanent crops Median", "Pasture Median", "Forestry Median", "Urban Median"]]
+    forestry_percentiles = [statistic for statistic in land_percentiles["Extensive forestry"] if statistic in land_percentiles["Intensive forestry"]]
+    for statistic in forestry_percentiles:
+        lci_land[f"Forestry {statistic}"] = lci_land[[f"Extensive forestry {statistic}", f"Intensive forestry {statistic}"]].mean(axis=1)
+    lci_land = lci_land[["Country", "Annual crops Median", "Permanent crops Median", "Pasture Median", "Forestry Median", "Urban Median",
+                         *[f"{land_type} {statistic}" for land_type in ["Annual crops", "Permanent crops", "Pasture"] for statistic in land_percentiles[land_type]],
+                         *[f"Forestry {statistic}" for statistic in forestry_percentiles],
+                         *[f"Urban {statistic}" for statistic in land_percentiles["Urban"]]]]
 
     # for water use
     # TODO: should we use 'all effects' or 'certain effects'?
-    lci_water = pd.read_excel(f"{lci_path}/12-water consumption/CFs_water_consumption_ecosystems_20180831.xlsx",
+    lci_water = pd.read_excel(f"{lci_path}/{LCI_FILES['water']}",
                         sheet_name="CF per countries",
                         dtype={1: float, 2: float},
                         skiprows=2)
     lci_water = lci_water[["Country", "CF all effects  [PDF·yr/m3]"]]
     
     # Add country codes to all LCI datasets and remove missing ones
-    lci_ozone["Country_Code"] = lci_ozone["Country"].apply(get_country_code)
-    lci_acidification["Country_Code"] = lci_acidification["Country"].apply(get_country_code)
-    lci_freshwater_eutrophication["Country_Code"] = lci_freshwater_eutrophication["Country"].apply(get_country_code)
-    lci_marine_eutrophication["Country_Code"] = lci_marine_eutrophication["Country"].apply(get_country_code)
-    lci_land["Country_Code"] = lci_land["Country"].apply(get_country_code)
-    lci_water["Country_Code"] = lci_water["Country"].apply(get_country_code)
+    missing_codes = {}
+    lci_ozone["Country_Code"], missing_codes["ozone"] = resolve_country_codes(lci_ozone["Country"], cache_dir)
+    lci_acidification["Country_Code"], missing_codes["acidification"] = resolve_country_codes(lci_acidification["Country"], cache_dir)
+    lci_freshwater_eutrophication["Country_Code"], missing_codes["freshwater_eutrophication"] = resolve_country_codes(lci_freshwater_eutrophication["Country"], cache_dir)
+    lci_marine_eutrophication["Country_Code"], missing_codes["marine_eutrophication"] = resolve_country_codes(lci_marine_eutrophication["Country"], cache_dir)
+    lci_land["Country_Code"], missing_codes["land"] = resolve_country_codes(lci_land["Country"], cache_dir)
+    lci_water["Country_Code"], missing_codes["water"] = resolve_country_codes(lci_water["Country"], cache_dir)
+    print("Alpha-2 country code does not exist for:")
+    print(json.dumps({category: names for category, names in missing_codes.items() if names}, indent=4, ensure_ascii=False))
     
     # Drop countries without alpha-2 code
     lci_ozone.dropna(subset=["Country_Code"], inplace=True)
@@ -96,82 +227,314 @@ def load_lci(lci_path):
     lci_land['Augmented'] = 'original'
     lci_water['Augmented'] = 'original'
     
-    return lci_climate, lci_ozone, lci_acidification, lci_freshwater_eutrophication, lci_marine_eutrophication, lci_land, lci_water
-
-
-def calculate_cba(exio3_11, diag_stressor, L):
-    print(f"Calculating CBA for {diag_stressor.name}")
-    diag_stressor.S = pymrio.calc_S(diag_stressor.F, exio3_11.x)
-    Y_agg = exio3_11.Y.groupby(level="region", axis=1, sort=False).sum()
-    diag_stressor.D_cba, _, _, _ = pymrio.calc_accounts(diag_stressor.S, L, Y_agg)
-    return diag_stressor.D_cba
-
-
-def get_country_code(name):
-    # custom mappings for countries that pycountry does not recognize
-    # these should cover all the countries in the LCI data if country has alpha-2 code
-    # these mappings were extracted manually
-    extra_mappings = {
-        "Turkey": "TR",
-        "Russia": "RU",
-        "Bahamas, The": "BS",
-        "Bonaire": "BQ",
-        "Byelarus": "BY",
-        "Brunei": "BN",
-        "Cape Verde": "CV",
-        "Cocos Islands": "CC",
-        "Congo DRC": "CD",
-        "China, Hong Kong Special Administrative Region": "HK",
-        "Curacao": "CW",
-        "Democratic Republic of the Congo": "CD",
-        "Falkland Islands": "FK",
-        "Falkland Islands (Islas Malvinas)": "FK",
-        "Gambia, The": "GM",
-        "Gaza Strip": "PS",
-        "Heard Island & McDonald Islands": "HM",
-        "Ivory Coast": "CI",
-        "Macedonia": "MK",
-        "The Former Yugoslav Republic of Macedonia": "MK",
-        "Macau": "MO",
-        "Man, Isle of": "IM",
-        "Micronesia": "FM",
-        "Myanmar (Burma)": "MM",
-        "Netherlands Antilles": "AN",
-        "Palestinian Territory": "PS",
-        "Pacific Islands (Palau)": "PW",
-        "Pitcairn Islands": "PN",
-        "Reunion": "RE",
-        "Saba": "BQ",
-        "Saint Eustatius": "BQ",
-        "Saint Helena": "SH",
-        "Saint Martin": "MF",
-        "Sint Maarten": "SX",
-        "South Georgia and the South Sandwich Is": "GS",
-        "South Georgia": "GS",
-        "St. Helena": "SH",
-        "Saint Barthelemy": "BL",
-        "Saint Kitts and Nevis": "KN",
-        "St. Kitts and Nevis": "KN",
-        "St. Lucia": "LC",
-        "St. Pierre and Miquelon": "PM",
-        "Sao Tomo and Principe": "ST",
-        "St. Vincent and the Grenadines": "VC",
-        "Svalbard": "SJ",
-        "Jan Mayen": "SJ",
-        "Swaziland": "SZ",
-        "US Virgin Islands": "VI",
-        "Virgin Islands": "VG",
-        "Western Samoa": "WS",
-        "West Bank": "PS",
+    return {
+        "climate": lci_climate,
+        "ozone": lci_ozone,
+        "acidification": lci_acidification,
+        "freshwater_eutrophication": lci_freshwater_eutrophication,
+        "marine_eutrophication": lci_marine_eutrophication,
+        "land": lci_land,
+        "water": lci_water,
     }
-    try:
-        return pyc.countries.lookup(name).alpha_2
-    except LookupError:
-        try:
-            return extra_mappings[name]
-        except LookupError:
-            print("Alpha-2 country code does not exist for ", name)
-            return None
+
+
+def percentile_of(label):
+    """
+    Percentile described by the statistic of an LC-IMPACT column label, e.g. 50 for 'Median', 2.5 for '2.5%',
+    'p2.5' or 'Lower 95% CI' and 97.5 for 'Upper 95% CI' or '97.5th percentile'. None if it isn't a percentile.
+    """
+    label = label.strip().lower()
+    if label == "median":
+        return 50.0
+    number = re.search(r"\d+(?:\.\d+)?", label)
+    if number is None:
+        return None
+    value = float(number.group())
+    bound = re.search(r"\b(lower|low|min|upper|high|max)\b", label)
+    if bound is not None:
+        lower = bound.group(1) in ("lower", "low", "min")
+        # bounds of an interval, e.g. 'Lower 95% CI', are given by the width of the interval
+        if re.search(r"\b(ci|confidence|interval|range)\b", label) or (lower and value > 50) or (not lower and value < 50):
+            value = (100 - value) / 2 if lower else 100 - (100 - value) / 2
+    elif not re.fullmatch(r"p?\s*\d+(?:\.\d+)?\s*(?:%|th|st|nd|rd)?\s*(?:percentile|quantile|perc\.?)?", label):
+        return None
+    return value if 0 < value < 100 else None
+
+
+def compile_lci(lci_tables):
+    """
+    Normalize the LCI datasets returned by read_lci_workbooks into one long table with a row per
+    (category, flow, Country_Code), where flow is the CF column of the category and CF_Value its value.
+    Returns the table and the column order of each dataset, which expand_lci needs to restore them.
+    """
+    frames = []
+    columns = {}
+    for category, lci in lci_tables.items():
+        columns[category] = list(lci.columns)
+        keys = [column for column in ["Substance", "Country", "Country_Code", "Augmented"] if column in lci.columns]
+        long = lci.reset_index(names="row").melt(id_vars=["row", *keys], var_name="flow", value_name="CF_Value")
+        long.insert(0, "category", category)
+        frames.append(long)
+    return pd.concat(frames, ignore_index=True), columns
+
+
+def expand_lci(store, columns):
+    """
+    Restore the LCI datasets from a table compiled with compile_lci, by name of the dataset in LCI_FILES.
+    """
+    lci_tables = {}
+    for category in LCI_FILES.keys():
+        long = store[store["category"] == category]
+        keys = [column for column in ["Substance", "Country", "Country_Code", "Augmented"] if column in columns[category]]
+        lci = long.drop_duplicates("row").set_index("row")[keys]
+        lci = lci.join(long.pivot(index="row", columns="flow", values="CF_Value"))
+        lci = lci[columns[category]]
+        lci.index.name = None
+        lci.columns.name = None
+        lci_tables[category] = lci
+    return lci_tables
+
+
+def load_lci(lci_path, cache_dir=None, rebuild_cache=False):
+    """
+    Load the LCI datasets by name of the dataset in LCI_FILES. With cache_dir the workbooks are compiled once into a CF store in cache_dir/lci,
+    which is read instead of the workbooks as long as the SHA-256 checksums of the workbooks match the ones
+    the store was compiled from. rebuild_cache compiles the store again.
+    """
+    if cache_dir is None:
+        return read_lci_workbooks(lci_path)
+
+    store_dir = os.path.join(cache_dir, "lci")
+    sources = {name: file_sha256(f"{lci_path}/{name}", cache_dir) for name in LCI_FILES.values()}
+    manifest = None
+    if os.path.exists(os.path.join(store_dir, "manifest.json")):
+        with open(os.path.join(store_dir, "manifest.json"), "r") as f:
+            manifest = json.load(f)
+    # country codes in the store depend on the country index
+    sources["country_index"] = hashlib.sha256(json.dumps(country_index(cache_dir), sort_keys=True).encode()).hexdigest()
+    if manifest is not None and not rebuild_cache and manifest["version"] == LCI_STORE_VERSION and manifest["sources"] == sources:
+        print(f"Loading LCI characterization factors from {store_dir}")
+        cache_event("lci", "hit", stage_key(sources))
+        store = pd.read_pickle(os.path.join(store_dir, "cfs.pkl"))
+        return expand_lci(store, manifest["columns"])
+
+    lci_tables = read_lci_workbooks(lci_path, cache_dir)
+    print(f"Compiling LCI characterization factors to {store_dir}")
+    cache_event("lci", "miss", stage_key(sources))
+    store, columns = compile_lci(lci_tables)
+    os.makedirs(store_dir, exist_ok=True)
+    # the manifest is written last, an interrupted compile leaves the previous manifest that no longer matches
+    store.to_pickle(os.path.join(store_dir, "cfs.pkl"))
+    with open(os.path.join(store_dir, "manifest.json"), "w") as f:
+        json.dump({"version": LCI_STORE_VERSION, "sources": sources, "columns": columns}, f, indent=4)
+    return lci_tables
+
+
+def factorize_leontief(exio3_11):
+    """
+    LU factorize (I - A) of the given system. Solving against the factorization gives the same result as
+    multiplying with L = (I - A)^-1 without building the dense inverse.
+    """
+    import scipy.linalg
+    print("Factorizing I - A (exio3_11)")
+    # build I - A in place on the array returned by calc_A, lu_factor overwrites it with the factors
+    I_minus_A = -pymrio.calc_A(exio3_11.Z, exio3_11.x).to_numpy()
+    I_minus_A[np.diag_indices_from(I_minus_A)] += 1
+    return scipy.linalg.lu_factor(I_minus_A, overwrite_a=True, check_finite=False)
+
+
+def aggregate_final_demand(exio3_11):
+    """
+    Final demand of exio3_11 summed over the final demand categories of each region.
+    """
+    return exio3_11.Y.groupby(level="region", axis=1, sort=False).sum()
+
+
+def calc_x_diag(exio3_11, L=None, lu=None, sectors_per_solve=20, dtype=np.float64):
+    """
+    Calculate the output of every region-sector driven by the final demand of each consumption region-sector.
+    This is L @ Y_diag as in pymrio.calc_accounts, where Y_diag is the final demand aggregated by region and
+    diagonalized to sectors. Only the rows of one sector are non-zero in each column of Y_diag, so the product
+    is built one sector at a time instead of multiplying with the full diagonalized final demand.
+    Either L or the LU factorization of (I - A) from factorize_leontief must be given. With the factorization
+    the columns of Y_diag are solved in batches of sectors_per_solve sectors.
+    With dtype float32 the product with L is calculated in float32, solutions against the factorization
+    are calculated in float64 and stored in float32.
+    """
+    print(f"Calculating L·Y by region ({np.dtype(dtype).name})")
+    Y_agg = aggregate_final_demand(exio3_11)
+    sectors = Y_agg.index.get_level_values("sector").unique()
+    n_sectors = len(sectors)
+    n_regions = Y_agg.shape[1]
+    Y_values = Y_agg.to_numpy()
+    x_diag = np.empty((Y_values.shape[0], n_regions * n_sectors), dtype=dtype)
+    # columns of consumption sector k are k, k + n_sectors, k + 2 * n_sectors, ... (one per region)
+    if lu is None:
+        L_values = L.to_numpy(dtype=dtype)
+        Y_values = Y_values.astype(dtype)
+        for sector in range(n_sectors):
+            x_diag[:, sector::n_sectors] = L_values[:, sector::n_sectors] @ Y_values[sector::n_sectors, :]
+    else:
+        import scipy.linalg
+        for start in range(0, n_sectors, sectors_per_solve):
+            batch = range(start, min(start + sectors_per_solve, n_sectors))
+            rhs = np.zeros((Y_values.shape[0], len(batch) * n_regions))
+            for i, sector in enumerate(batch):
+                rhs[sector::n_sectors, i * n_regions:(i + 1) * n_regions] = Y_values[sector::n_sectors, :]
+            solved = scipy.linalg.lu_solve(lu, rhs, check_finite=False)
+            for i, sector in enumerate(batch):
+                x_diag[:, sector::n_sectors] = solved[:, i * n_regions:(i + 1) * n_regions]
+    columns = pd.MultiIndex.from_product([Y_agg.columns, sectors], names=[*Y_agg.columns.names, "sector"])
+    return pd.DataFrame(x_diag, index=Y_agg.index, columns=columns)
+
+
+def x_diag_labels(exio3_11):
+    """
+    Index and columns of L·Y_diag as calculated by calc_x_diag, without calculating it.
+    """
+    Y_agg = aggregate_final_demand(exio3_11)
+    sectors = Y_agg.index.get_level_values("sector").unique()
+    return Y_agg.index, pd.MultiIndex.from_product([Y_agg.columns, sectors], names=[*Y_agg.columns.names, "sector"])
+
+
+def x_diag_columns(exio3_11, columns, L=None, lu=None):
+    """
+    The given columns (positions) of L·Y_diag as calculated by calc_x_diag, in float64.
+    Used as the reference of a float32 calculation.
+    """
+    Y_values = aggregate_final_demand(exio3_11).to_numpy()
+    n_sectors = Y_values.shape[0] // exio3_11.get_regions().size
+    rhs = np.zeros((Y_values.shape[0], len(columns)))
+    for i, column in enumerate(columns):
+        region, sector = divmod(column, n_sectors)
+        rhs[sector::n_sectors, i] = Y_values[sector::n_sectors, region]
+    if lu is None:
+        return L.to_numpy() @ rhs
+    import scipy.linalg
+    return scipy.linalg.lu_solve(lu, rhs, check_finite=False)
+
+
+def convert_leontief(exio3_11, dtype):
+    """
+    L of exio3_11 in dtype for calc_x_diag. A float32 L is converted once and the float64 L and A are dropped
+    from the system, so that only the float32 copy is kept next to L·Y.
+    """
+    if np.dtype(dtype) == np.float64:
+        return exio3_11.L
+    L = exio3_11.L.astype(dtype)
+    exio3_11.A = None
+    exio3_11.L = None
+    return L
+
+
+def stressor_intensity(exio3_11, satellite, stressor_name):
+    """
+    Stressor per unit of output of each region-sector of exio3_11 (the row of S of the stressor).
+    For a list of stressors the rows of S of all of them are calculated at once, as a (stressors, rows) array.
+    """
+    if isinstance(stressor_name, str):
+        return pymrio.calc_S(satellite.F.loc[[stressor_name]], exio3_11.x).to_numpy()[0]
+    return pymrio.calc_S(satellite.F.loc[list(stressor_name)], exio3_11.x).to_numpy()
+
+
+def calculate_cba(exio3_11, satellite, stressor_name):
+    """
+    D_cba of a stressor. For a list of stressors the D_cba of all of them are stacked, with the stressor as the
+    first level of the index, from one calculation of their intensities against the shared x_diag.
+    """
+    # for a diagonalized stressor D_cba = diag(S) @ L @ Y_diag, i.e. the rows of x_diag scaled by the stressor intensity
+    x_diag = exio3_11.x_diag
+    if isinstance(stressor_name, str):
+        print(f"Calculating CBA for {stressor_name}")
+        D_cba = x_diag * stressor_intensity(exio3_11, satellite, stressor_name).astype(x_diag.to_numpy().dtype)[:, np.newaxis]
+        return D_cba
+
+    print(f"Calculating CBA for {', '.join(stressor_name)}")
+    values = x_diag.to_numpy()
+    s = stressor_intensity(exio3_11, satellite, stressor_name).astype(values.dtype)
+    stacked = (s[:, :, np.newaxis] * values[np.newaxis]).reshape(-1, values.shape[1])
+    index = pd.MultiIndex.from_tuples([(name, *row) for name in stressor_name for row in x_diag.index], names=["stressor", *x_diag.index.names])
+    return pd.DataFrame(stacked, index=index, columns=x_diag.columns)
+
+
+def country_index(cache_dir=None):
+    """
+    Index from lower case country name to alpha-2 code. Contains the codes and names pycountry.countries.lookup
+    matches (alpha-2, alpha-3, numeric, name, official name and common name) and EXTRA_COUNTRY_MAPPINGS for names
+    pycountry does not recognize. With cache_dir the index is stored in cache_dir/country-index.json so that later
+    runs do not need to load the pycountry databases. The index is also kept in memory for the rest of the run.
+    """
+    from importlib.metadata import version
+    key = hashlib.sha256(json.dumps([version("pycountry"), EXTRA_COUNTRY_MAPPINGS], sort_keys=True).encode()).hexdigest()
+    if key in COUNTRY_INDEXES:
+        return COUNTRY_INDEXES[key]
+
+    index_path = os.path.join(cache_dir, "country-index.json") if cache_dir else None
+    if index_path and os.path.exists(index_path):
+        with open(index_path, "r") as f:
+            cached = json.load(f)
+        if cached["key"] == key:
+            COUNTRY_INDEXES[key] = cached["index"]
+            return cached["index"]
+
+    index = {name.lower(): code for name, code in EXTRA_COUNTRY_MAPPINGS.items()}
+    pycountry_index = {}
+    # fields in the order pycountry.countries.lookup tries them, the first match wins
+    for field in ["alpha_2", "alpha_3", "numeric", "name", "official_name", "common_name"]:
+        for country in pyc.countries:
+            value = getattr(country, field, None)
+            if value is not None:
+                pycountry_index.setdefault(value.lower(), country.alpha_2)
+    # pycountry is tried before the extra mappings
+    index.update(pycountry_index)
+
+    if index_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(index_path, "w") as f:
+            json.dump({"key": key, "index": index}, f)
+    COUNTRY_INDEXES[key] = index
+    return index
+
+
+def resolve_country_codes(names, cache_dir=None):
+    """
+    Map a Series of country names to alpha-2 codes in one pass. Names without a code are mapped to NaN.
+    Returns the codes and the sorted list of names that could not be resolved.
+    """
+    codes = names.str.lower().map(country_index(cache_dir))
+    missing = sorted(set(names[codes.isna()].astype(str)))
+    return codes, missing
+
+
+def aggregate_satellite(satellite, grouping_pattern, name):
+    """
+    Aggregate the stressors of a satellite account with a grouping pattern (regex of stressor -> name of the
+    group, later patterns win as in pymrio Extension.get_index). Returns a new extension with F, M and unit of
+    the groups only, built from the rows matching the pattern without copying the satellite. Aggregations are
+    memoised by satellite and grouping pattern, the given satellite is not modified.
+    """
+    key = (id(satellite), json.dumps(grouping_pattern, sort_keys=True))
+    with AGGREGATION_LOCK:
+        if key in AGGREGATED_SATELLITES:
+            return AGGREGATED_SATELLITES[key][1]
+
+    groups = {}
+    for pattern, group in grouping_pattern.items():
+        groups.update({stressor: group for stressor in satellite.F.index if re.match(pattern, stressor)})
+    # keep the order of the satellite so that the groups are summed in the same order as by pymrio
+    rows = [stressor for stressor in satellite.F.index if stressor in groups]
+    by = [groups[stressor] for stressor in rows]
+
+    tables = {"F": satellite.F.loc[rows].groupby(by).sum()}
+    if getattr(satellite, "M", None) is not None:
+        tables["M"] = satellite.M.loc[rows].groupby(by).sum()
+    if getattr(satellite, "unit", None) is not None:
+        tables["unit"] = satellite.unit.loc[rows].groupby(by)["unit"].agg(lambda x: " & ".join(x.unique())).to_frame("unit")
+    satellite_agg = pymrio.Extension(name=name, **tables)
+
+    with AGGREGATION_LOCK:
+        # the satellite is kept with its aggregation so that its id is not reused while memoised
+        return AGGREGATED_SATELLITES.setdefault(key, (satellite, satellite_agg))[1]
 
 
 def get_row_regions(lci_country_codes, exio_country_codes):
@@ -207,84 +570,75 @@ def dr_s(D_cba):
     dr_s = pd.DataFrame(columns)
     return dr_s
 
-def dr_u(dr_s, row_region_mappings, row_countries):
-    print("Calculating dr_u")
-    # Get region mappings from arguments
-    row_eu_countries = row_region_mappings["row_eu"]
-    row_asia_pacific_countries = row_region_mappings["row_asia_pacific"]
-    row_african_countries = row_region_mappings["row_africa"]
-    row_american_countries = row_region_mappings["row_america"]
-    row_middle_eastern_countries = row_region_mappings["row_middle_east"]
+# rest of the world region of the countries in each row_region_mappings group, in order of precedence
+ROW_REGION_MAPPINGS = {"row_eu": "WE", "row_asia_pacific": "WA", "row_africa": "WF", "row_america": "WL", "row_middle_east": "WM"}
 
-    row_regions = {
-        "WA": "Asia and pacific",
-        "WE": "Europe",
-        "WF": "Africa",
-        "WM": "Middle east",
-        "WL": "America"
-    }
+# plan of the expansion of dr_s to dr_u, see region_expansion
+RegionExpansion = namedtuple("RegionExpansion", ["index", "columns", "source_rows", "scale", "keep_columns", "n_source_rows"])
+
+
+def consumption_columns(columns):
+    """
+    Positions and labels of the columns of L·Y_diag (columns) without the rest of the world regions, which are
+    not consumption regions. They are the columns of the results and the same in every region_expansion.
+    """
+    keep_columns = np.flatnonzero(~columns.get_level_values(0).isin(list(ROW_REGIONS.keys())))
+    return keep_columns, columns[keep_columns]
 
-    # augment dr_s to create dr_u
-    # new regions are calculated by dividing their corresponding row region by the number of countries in the row region
-    # for example, row region Argentina is sub-matrix WA divided by the number of countries in row region WA
-    wl = dr_s.loc["WL"].copy()
-    wl = wl / len(row_american_countries)
-
-    we = dr_s.loc["WE"].copy()
-    we = we / len(row_eu_countries)
-
-    wa = dr_s.loc["WA"].copy()
-    wa = wa / len(row_asia_pacific_countries)
-
-    wf = dr_s.loc["WF"].copy()
-    wf = wf / len(row_african_countries)
-
-    wm = dr_s.loc["WM"].copy()
-    wm = wm / len(row_middle_eastern_countries)
-
-    dr_u = dr_s.copy()
-    dr_u = dr_u.drop(index=list(row_regions.keys()), level='region')
-
-    # build a mapping of country codes to region dataframes - only for row countries 
-    country_to_region = {}
-    for region in row_countries:
-        if region in row_eu_countries:
-            country_to_region[region] = we
-        elif region in row_asia_pacific_countries:
-            country_to_region[region] = wa
-        elif region in row_african_countries:
-            country_to_region[region] = wf
-        elif region in row_american_countries:
-            country_to_region[region] = wl
-        elif region in row_middle_eastern_countries:
-            country_to_region[region] = wm
-        else:
-            print(f"Country {region} not found in any mapping, skipping.")
-
-    # add all new regions that don't exist in exiobase to dr_u
-    all_indices = []
-    all_data = []
-    for region in row_countries:
-        if region in country_to_region:  # Only add if we found a mapping
-            region_data = country_to_region[region].copy()
-            idx = pd.MultiIndex.from_product([[region],region_data.index], names=['region', 'sector'])
-            all_indices.append(idx)
-            all_data.append(region_data)
-        else:
-            print(f"ERROR: Region %s not found in country to region map, this should not happen", region)
 
-    combined_idx = pd.MultiIndex.from_tuples(
-        [idx for subidx in all_indices for idx in subidx]
+def region_expansion(index, columns, row_region_mappings, row_countries):
+    """
+    Plan the expansion of dr_s (rows index, columns columns) to dr_u. Rows of the rest of the world regions are
+    replaced by a copy for each of the row_countries, divided by the number of countries in its row region
+    (for example, row region Argentina is sub-matrix WL divided by the number of countries in row region WL),
+    and the rest of the world regions are removed from the consumption regions (columns).
+    Row i of dr_u is row source_rows[i] of dr_s times scale[i], its columns are the columns keep_columns of dr_s.
+    The plan only depends on the index of the system and the LCI dataset, so it is shared by all stressors.
+    """
+    regions = index.get_level_values(0)
+    sectors = index.get_level_values(1)
+
+    source_rows = [np.flatnonzero(~regions.isin(list(ROW_REGIONS.keys())))]
+    scale = [np.ones(len(source_rows[0]))]
+    target_regions = [regions[source_rows[0]]]
+    for country in row_countries:
+        for mapping, row_region in ROW_REGION_MAPPINGS.items():
+            if country in row_region_mappings[mapping]:
+                break
+        else:
+            print(f"Country {country} not found in any mapping, skipping.")
+            continue
+        rows = np.flatnonzero(regions == row_region)
+        source_rows.append(rows)
+        scale.append(np.full(len(rows), 1 / len(row_region_mappings[mapping])))
+        target_regions.append(np.repeat(country, len(rows)))
+
+    source_rows = np.concatenate(source_rows)
+    keep_columns, consumption_labels = consumption_columns(columns)
+    return RegionExpansion(
+        index=pd.MultiIndex.from_arrays([np.concatenate(target_regions), sectors[source_rows]], names=index.names),
+        columns=consumption_labels,
+        source_rows=source_rows,
+        scale=np.concatenate(scale),
+        keep_columns=keep_columns,
+        n_source_rows=len(index),
     )
 
-    combined_data = pd.concat(all_data)
-    combined_data.index = combined_idx
 
-    dr_u = pd.concat([dr_u, combined_data])
+def collapse_rows(expansion, weights):
+    """
+    Collapse weights of the rows of dr_u to weights of the rows of dr_s, so that
+    collapse_rows(expansion, weights) @ dr_s[:, keep_columns] == weights @ dr_u without building dr_u.
+    """
+    return np.bincount(expansion.source_rows, weights=weights * expansion.scale, minlength=expansion.n_source_rows)
+
 
-    # remove row regions from consumption regions (columns)
-    dr_u = dr_u.drop(columns=row_regions.keys(), axis=1, level=0)
-    return dr_u
+def dr_u(dr_s, expansion):
+    print("Calculating dr_u")
+    # one gather of the rows and columns of dr_s given by the expansion plan
+    values = dr_s.to_numpy()[np.ix_(expansion.source_rows, expansion.keep_columns)]
+    values *= expansion.scale[:, np.newaxis]
+    return pd.DataFrame(values, index=expansion.index, columns=expansion.columns)
 
 
 def dr_f(satellite, dr_u, stressor_name):
@@ -301,85 +655,239 @@ def dr_f(satellite, dr_u, stressor_name):
     }
     satellite_cleaned = satellite.M.drop(columns=row_regions.keys(), axis=1, level=0)
     total = satellite_cleaned.loc[stressor_name]
-    scalars = total.to_numpy() # multipliers for each column
+    scalars = total.to_numpy(dtype=dr_u.to_numpy().dtype) # multipliers for each column, in the precision of dr_u
 
     # multiply each column of dr_u by the respective column value from exio3_19 impact factors
     dr_f = dr_f * scalars # same as dr_f * diag(scalars) but more efficient with numpy broadcasting
     return dr_f
 
 
+def row_cfs(lci, index, cf_name):
+    """
+    CF of the region of each row of index (region, sector), regions without CF get 0 so that they don't contribute.
+    """
+    # Country codes should already be added in load_lci function
+    # the first row of a country is used if lci has duplicates
+    lci_unique = lci.drop_duplicates(subset="Country_Code").set_index("Country_Code")
+    cf = lci_unique[cf_name].reindex(index.get_level_values(0)).to_numpy(dtype=float)
+    cf[np.isnan(cf)] = 0
+    return cf
+
+
 def pdf(lci, dr_f, stressor_name):
     print(f"Calculating PDF/€ {stressor_name}")
-    # Country codes should already be added in load_lci function
-    # Make a copy to avoid modifying the original dataframe
-    lci_copy = lci.copy()
-    lci_copy.set_index("Country_Code", inplace=True)
-    # Ensure lci index is unique before reindexing
-    lci_copy = lci_copy[~lci_copy.index.duplicated(keep='first')]
-    # sort rows on lci in same order as dr_f.index.sortlevel
-    lci_reindexed = lci_copy.reindex(dr_f.index.get_level_values(0).unique())
-
-    # build array from the relevent lci stressor
-    # every value should be repeated 200 times (number of sectors)
-    cf = lci_reindexed[stressor_name].to_numpy()
-    cf = np.repeat(cf, 200) # 1D array of length 200 * number of regions in lci
-    # expand cf_all_effects to match the shape of dr_f
-    cf = np.tile(cf, (dr_f.shape[1], 1)).T
-
-    pdf = dr_f * cf
-    pdf_total = pdf.sum()
-    return pdf_total
-
-
-def ozone_formation(lci_ozone, exio3_19, exio3_11, row_region_mappings, store_matrix=False, store_cfs=False):
-    print("Calculating PDF/€ ozone formation")
-    
-    # Get EXIOBASE regions
-    exio_regions = exio3_19.get_regions()
-    
-    # Get row regions for ozone
-    row_ozone = get_row_regions(lci_ozone["Country_Code"].tolist(), exio_regions)
-    print("Row regions for ozone:", row_ozone)
-    
-    nmvoc_diag = exio3_11.satellite.diag_stressor(("NMVOC - combustion - air"))
-    nox_diag = exio3_11.satellite.diag_stressor(("NOx - combustion - air"))
+    cf = row_cfs(lci, dr_f.index, stressor_name)
 
-    D_cba_nmvoc = calculate_cba(exio3_11, nmvoc_diag, exio3_11.L)
-    D_cba_nox = calculate_cba(exio3_11, nox_diag, exio3_11.L)
+    # sum of CF-weighted rows of every column as a single product, without a CF matrix the size of dr_f
+    values = dr_f.to_numpy()
+    pdf_total = cf @ values
+    # columns with missing values (e.g. shares of a stressor without any emissions) are summed skipping them
+    missing = np.isnan(pdf_total)
+    if missing.any():
+        pdf_total[missing] = np.nansum(cf[:, np.newaxis] * values[:, missing], axis=0)
+    return pd.Series(pdf_total, index=dr_f.columns)
 
-    dr_s_nmvoc = dr_s(D_cba_nmvoc)
-    dr_s_nox = dr_s(D_cba_nox)
 
-    dr_u_nmvoc = dr_u(dr_s_nmvoc, row_region_mappings, row_ozone)
-    dr_u_nox = dr_u(dr_s_nox, row_region_mappings, row_ozone)
+def fused_pdf(x_diag, s, m, weights, keep_columns, rows=None, block_size=512, stressors=None):
+    """
+    PDF/€ of a stressor for the CF weights of one or more categories in a single pass over blocks of columns of
+    x_diag, without building D_cba, dr_s, dr_u or dr_f. For column j of the kept columns
+    pdf[j] = m[j] / colsum[j] * sum_i weights[i] * s[i] * x_diag[i, j], colsum[j] = sum_i s[i] * x_diag[i, j]
+    which is the CF-weighted column sum of dr_f. x_diag is L·Y_diag, s the stressor intensity (row of S),
+    m the multipliers of the kept columns and weights a (rows of x_diag, categories) array of CFs collapsed to the
+    rows of x_diag with collapse_rows. Columns without the stressor (colsum 0) get 0 like the skipped missing
+    values of pdf. Returns a (categories, kept columns) array.
+    Several stressors are calculated in the same pass with s (stressors, rows), m (stressors, kept columns) and
+    stressors, the row of s and m of each category, so that each block of x_diag is read once for all of them.
+    With rows only those rows of x_diag are read, the other rows must have s 0 (see stressor_rows).
+    """
+    s = np.atleast_2d(s)
+    m = np.atleast_2d(m)
+    if stressors is None:
+        stressors = np.zeros(weights.shape[1], dtype=int)
+    if rows is not None:
+        s = s[:, rows]
+        weights = weights[rows]
+    # calculate in the precision of x_diag
+    s = s.astype(x_diag.dtype)
+    weighted = (weights * s[stressors].T).astype(x_diag.dtype)
+    result = np.empty((weights.shape[1], len(keep_columns)))
+    for start in range(0, len(keep_columns), block_size):
+        end = start + block_size
+        if rows is None:
+            block = x_diag[:, keep_columns[start:end]]
+        else:
+            block = x_diag[np.ix_(rows, keep_columns[start:end])]
+        colsum = s @ block
+        with np.errstate(divide="ignore", invalid="ignore"):
+            pdf_block = (weighted.T @ block) * (m[stressors, start:end] / colsum[stressors])
+        pdf_block[~np.isfinite(pdf_block)] = 0
+        result[:, start:end] = pdf_block
+    return result
 
-    dr_f_nmvoc = dr_f(exio3_19.satellite, dr_u_nmvoc, "NMVOC - combustion - air")
-    dr_f_nox = dr_f(exio3_19.satellite, dr_u_nox, "NOx - combustion - air")
 
-    # Save matrices if enabled
-    if store_matrix:
-        import pickle
-        with open("pipeline/output/matrices/pdf-matrix-ozone-nmvoc.pkl", "wb") as f:
-            pickle.dump(dr_f_nmvoc, f)
-        with open("pipeline/output/matrices/pdf-matrix-ozone-nox.pkl", "wb") as f:
-            pickle.dump(dr_f_nox, f)
+def region_indicator(index):
+    """
+    Weights (rows of index, regions) that are 1 for the region of each row, with which fused_pdf calculates
+    the region_attribution of a stressor. Returns the weights and the regions.
+    """
+    codes, regions = pd.factorize(index.get_level_values(0))
+    indicator = np.zeros((len(codes), len(regions)))
+    indicator[np.arange(len(codes)), codes] = 1
+    return indicator, regions
 
-    # Save CFs if enabled
-    if store_cfs:
-        # Store NMVOC CFs
-        cf_nmvoc = lci_ozone[["Country_Code", "NMVOC", "Augmented"]].copy()
-        cf_nmvoc.columns = ["Country_Code", "CF_Value", "Augmented"]
-        cf_nmvoc.to_csv("pipeline/output/cfs/cfs-ozone-nmvoc.csv", index=False)
-        
-        # Store NOx CFs
-        cf_nox = lci_ozone[["Country_Code", "NOx", "Augmented"]].copy()
-        cf_nox.columns = ["Country_Code", "CF_Value", "Augmented"]
-        cf_nox.to_csv("pipeline/output/cfs/cfs-ozone-nox.csv", index=False)
 
-    ozone_nmvoc = pdf(lci_ozone, dr_f_nmvoc, "NMVOC")
-    ozone_nox = pdf(lci_ozone, dr_f_nox, "NOx")
+def region_attribution(x_diag, s, m, index, expansion, rows=None):
+    """
+    Attribution of the PDF/€ of a stressor to the producing regions, row r column j is
+    m[j] / colsum[j] * sum_i s[i] * x_diag[i, j] over the rows i of region r (see fused_pdf). It doesn't depend
+    on the CFs, region_pdf calculates the PDF/€ of any CFs from it. index are the rows of x_diag.
+    Returns a DataFrame (regions, columns of the expansion).
+    """
+    indicator, regions = region_indicator(index)
+    return pd.DataFrame(fused_pdf(x_diag, s, m, indicator, expansion.keep_columns, rows), index=regions, columns=expansion.columns)
+
 
-    return ozone_nmvoc, ozone_nox
+def region_pdf(index, weights, attribution):
+    """
+    PDF/€ of CF weights (rows of x_diag with the index, categories) from the region_attribution of a stressor.
+    The weights from collapse_rows are the same for all sectors of a region, so the product is per region.
+    Returns a (categories, columns of the attribution) array.
+    """
+    codes = attribution.index.get_indexer(index.get_level_values(0))
+    region_weights = np.zeros((len(attribution.index), weights.shape[1]))
+    region_weights[codes] = weights
+    assert np.array_equal(region_weights[codes], weights), "CF weights differ between the sectors of a region"
+    return region_weights.T @ attribution.to_numpy()
+
+
+def cf_percentiles(lci, cf_name, override=None):
+    """
+    Columns of the percentiles of the CF column cf_name in an LCI dataset (percentile -> column), detected from
+    the columns with the same label as cf_name up to the statistic, e.g. 'Pasture 2.5%' for 'Pasture Median'.
+    override ({percentile: column} from the cf_percentiles of an impact category) replaces the detection.
+    Empty if fewer than two percentiles are found, the CFs are then the same in every draw.
+    """
+    if override is not None:
+        return {float(percentile): column for percentile, column in override.items()}
+    words = cf_name.split(" ")
+    for i in range(len(words) - 1, 0, -1):
+        if percentile_of(" ".join(words[i:])) is not None:
+            label = " ".join(words[:i]) + " "
+            percentiles = {percentile_of(column[len(label):]): column for column in lci.columns
+                           if column.startswith(label) and percentile_of(column[len(label):]) is not None}
+            return percentiles if len(percentiles) > 1 else {}
+    return {}
+
+
+def sample_cfs(lci, cf_name, percentile_columns, n_draws, rng):
+    """
+    Draw n_draws realisations of the CF of every country of an LCI dataset from its percentiles (percentile ->
+    column, see cf_percentiles). Each draw takes a standard normal score per country and interpolates the
+    percentiles of the country at that score, in log space if they are all positive (lognormal between the
+    percentiles) and linearly otherwise, beyond the outermost percentiles along the outermost segments.
+    Countries without percentiles (e.g. augmented ones) keep cf_name in every draw.
+    Returns a (draws, countries) array and the country codes.
+    """
+    lci_unique = lci.drop_duplicates(subset="Country_Code").set_index("Country_Code")
+    cf = lci_unique[cf_name].to_numpy(dtype=float)
+    if len(percentile_columns) < 2:
+        return np.tile(cf, (n_draws, 1)), lci_unique.index
+    percentiles = sorted(percentile_columns)
+    scores = np.array([NormalDist().inv_cdf(percentile / 100) for percentile in percentiles])
+    values = np.sort(lci_unique[[percentile_columns[percentile] for percentile in percentiles]].to_numpy(dtype=float), axis=1)
+    positive = np.all(values > 0, axis=1)
+    points = np.where(positive[:, np.newaxis], np.log(np.where(values > 0, values, 1)), values)
+
+    z = rng.standard_normal((n_draws, len(cf)))
+    segment = np.clip(np.searchsorted(scores, z) - 1, 0, len(scores) - 2)
+    countries = np.arange(len(cf))
+    low, high = points[countries, segment], points[countries, segment + 1]
+    draws = low + (z - scores[segment]) / (scores[segment + 1] - scores[segment]) * (high - low)
+    draws = np.where(positive, np.exp(draws), np.maximum(draws, np.minimum(values[:, 0], 0)))
+    missing = np.isnan(values).any(axis=1)
+    draws[:, missing] = cf[missing]
+    return draws, lci_unique.index
+
+
+def region_cf_draws(lci, expansion, index, regions, cf_name, percentile_columns, n_draws, rng):
+    """
+    n_draws realisations of the CF weights of the regions of a region_attribution (see region_pdf), with the CFs
+    of the countries drawn with sample_cfs. index are the rows of x_diag. Returns a (draws, regions) array.
+    """
+    draws, countries = sample_cfs(lci, cf_name, percentile_columns, n_draws, rng)
+    draws[np.isnan(draws)] = 0
+    # the weights are the same for all sectors of a region, so only the rows of dr_u collapsed to the first row of
+    # x_diag of each region are needed
+    codes = regions.get_indexer(index.get_level_values(0))
+    _, first_rows = np.unique(codes, return_index=True)
+    targets = np.flatnonzero(np.isin(expansion.source_rows, first_rows))
+    positions = countries.get_indexer(expansion.index.get_level_values(0)[targets])
+    target_draws = np.where(positions >= 0, draws[:, positions], 0) * expansion.scale[targets]
+    target_regions = np.zeros((len(targets), len(regions)))
+    target_regions[np.arange(len(targets)), codes[expansion.source_rows[targets]]] = 1
+    return target_draws @ target_regions
+
+
+def pdf_bands(region_draws, attribution, percentiles):
+    """
+    Percentiles and mean of the PDF/€ over the draws of CF weights (draws, regions) from region_cf_draws, all
+    draws calculated as one product with the region_attribution. Returns a DataFrame (columns of the attribution,
+    p<percentile> and mean).
+    """
+    pdf_draws = region_draws @ attribution.to_numpy()
+    bands = np.percentile(pdf_draws, percentiles, axis=0).T
+    return pd.DataFrame(np.column_stack([bands, pdf_draws.mean(axis=0)]), index=attribution.columns,
+                        columns=[f"p{percentile:g}" for percentile in percentiles] + ["mean"])
+
+
+def stressor_rows(s, stressor_name, sparse_threshold):
+    """
+    Rows (producing region-sectors) with the stressor if they are a smaller share of all rows than
+    sparse_threshold, otherwise None. Only these rows of D_cba, dr_s, dr_u and dr_f can be non-zero.
+    """
+    rows = np.flatnonzero(s)
+    density = len(rows) / len(s)
+    print(f"{stressor_name} is non-zero in {len(rows)} of {len(s)} rows (density {density:.3f})")
+    return rows if density < sparse_threshold else None
+
+
+def sparse_dr_f(x_diag, s, m, rows, expansion):
+    """
+    dr_f of a stressor as a scipy.sparse CSR matrix built from the rows with the stressor only (see stressor_rows).
+    Columns without the stressor (0/0) or without a multiplier are missing (NaN) in every row as in the dense
+    dr_f, so both give the same matrix. Returns the matrix as a sparse DataFrame.
+    """
+    import scipy.sparse
+    print("Calculating sparse dr_f")
+    D_cba = x_diag[np.ix_(rows, expansion.keep_columns)] * s[rows, np.newaxis].astype(x_diag.dtype)
+    colsum = D_cba.sum(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dr_f_rows = D_cba * (m / colsum)
+    dr_f_rows[~np.isfinite(dr_f_rows)] = 0
+    del D_cba
+
+    # expand the rows with the stressor to the rows of dr_u as planned by region_expansion
+    targets = np.flatnonzero(np.isin(expansion.source_rows, rows))
+    expand = scipy.sparse.csr_matrix(
+        (expansion.scale[targets], (targets, np.searchsorted(rows, expansion.source_rows[targets]))),
+        shape=(len(expansion.index), len(rows)))
+    dr_f = expand @ scipy.sparse.csr_matrix(dr_f_rows)
+    missing = np.flatnonzero((colsum == 0) | np.isnan(m))
+    if len(missing) > 0:
+        n_rows = len(expansion.index)
+        dr_f = dr_f + scipy.sparse.csr_matrix(
+            (np.full(n_rows * len(missing), np.nan, dtype=dr_f.dtype), (np.repeat(np.arange(n_rows), len(missing)), np.tile(missing, n_rows))),
+            shape=dr_f.shape)
+    return pd.DataFrame.sparse.from_spmatrix(dr_f, index=expansion.index, columns=expansion.columns)
+
+
+def max_relative_deviation(values, reference):
+    """
+    Maximum of |values - reference| / |reference| over the non-zero values of reference.
+    """
+    nonzero = reference != 0
+    return float(np.max(np.abs(values[nonzero] - reference[nonzero]) / np.abs(reference[nonzero]), initial=0))
 
 
 def get_missing_from_lci(exio_regions, lci):
@@ -428,80 +936,6 @@ def augment_acid(lci_acidification):
     return lci_acidification
 
 
-def acidification(lci_acidification, exio3_19, exio3_11, row_region_mappings, store_matrix=False, store_cfs=False):
-    print("Calculating PDF/€ acidification")
-    
-    # Get EXIOBASE regions
-    exio_regions = exio3_19.get_regions()
-    
-    # Define row regions (rest of world regions in EXIOBASE)
-    row_regions = {"WA": "Asia and pacific", "WE": "Europe", "WF": "Africa", "WM": "Middle east", "WL": "America"}
-    exio_regions_without_row = [region for region in exio_regions if region not in row_regions.keys()]
-    
-    # Check if acidification data needs augmentation
-    if len(get_missing_from_lci(exio_regions_without_row, lci_acidification)) > 0:
-        print("Missing from LCI acidification:", get_missing_from_lci(exio_regions_without_row, lci_acidification))
-        lci_acidification = augment_acid(lci_acidification)
-        assert len(get_missing_from_lci(exio_regions_without_row, lci_acidification)) == 0, "There are still missing regions in acidification after augmentation"
-    
-    # Get row regions for acidification
-    row_acidification = get_row_regions(lci_acidification["Country_Code"].tolist(), exio_regions)
-    print("Row regions for acidification:", row_acidification)
-    
-    nox_diag = exio3_11.satellite.diag_stressor(("NOx - combustion - air"))
-    nh3_diag = exio3_11.satellite.diag_stressor(("NH3 - agriculture - air"))
-    sox_diag = exio3_11.satellite.diag_stressor(("SOx - combustion - air"))
-
-    D_cba_nox = calculate_cba(exio3_11, nox_diag, exio3_11.L)
-    D_cba_nh3 = calculate_cba(exio3_11, nh3_diag, exio3_11.L)
-    D_cba_sox = calculate_cba(exio3_11, sox_diag, exio3_11.L)
-
-    dr_s_nox = dr_s(D_cba_nox)
-    dr_s_nh3 = dr_s(D_cba_nh3)
-    dr_s_sox = dr_s(D_cba_sox)
-
-    dr_u_nox = dr_u(dr_s_nox, row_region_mappings, row_acidification)
-    dr_u_nh3 = dr_u(dr_s_nh3, row_region_mappings, row_acidification)
-    dr_u_sox = dr_u(dr_s_sox, row_region_mappings, row_acidification)
-
-    dr_f_nox = dr_f(exio3_19.satellite, dr_u_nox, "NOx - combustion - air")
-    dr_f_nh3 = dr_f(exio3_19.satellite, dr_u_nh3, "NH3 - agriculture - air")
-    dr_f_sox = dr_f(exio3_19.satellite, dr_u_sox, "SOx - combustion - air")
-
-    # Save matrices if enabled
-    if store_matrix:
-        import pickle
-        with open("pipeline/output/matrices/pdf-matrix-acidification-nox.pkl", "wb") as f:
-            pickle.dump(dr_f_nox, f)
-        with open("pipeline/output/matrices/pdf-matrix-acidification-nh3.pkl", "wb") as f:
-            pickle.dump(dr_f_nh3, f)
-        with open("pipeline/output/matrices/pdf-matrix-acidification-sox.pkl", "wb") as f:
-            pickle.dump(dr_f_sox, f)
-
-    # Save CFs if enabled
-    if store_cfs:
-        # Store NOx CFs
-        cf_nox = lci_acidification[["Country_Code", "CF Nox", "Augmented"]].copy()
-        cf_nox.columns = ["Country_Code", "CF_Value", "Augmented"]
-        cf_nox.to_csv("pipeline/output/cfs/cfs-acidification-nox.csv", index=False)
-        
-        # Store NH3 CFs
-        cf_nh3 = lci_acidification[["Country_Code", "CF NH3", "Augmented"]].copy()
-        cf_nh3.columns = ["Country_Code", "CF_Value", "Augmented"]
-        cf_nh3.to_csv("pipeline/output/cfs/cfs-acidification-nh3.csv", index=False)
-        
-        # Store SOx CFs
-        cf_sox = lci_acidification[["Country_Code", "CF Sox", "Augmented"]].copy()
-        cf_sox.columns = ["Country_Code", "CF_Value", "Augmented"]
-        cf_sox.to_csv("pipeline/output/cfs/cfs-acidification-sox.csv", index=False)
-
-    acidification_nox = pdf(lci_acidification, dr_f_nox, "CF Nox")
-    acidification_nh3 = pdf(lci_acidification, dr_f_nh3, "CF NH3")
-    acidification_sox = pdf(lci_acidification, dr_f_sox, "CF Sox")
-
-    return acidification_nox, acidification_nh3, acidification_sox
-
-
 def augment_land(lci_land):
     # taiwan is missing from lc-impact, add taiwan as new row with country code TW and asia averages
     cf_annual_asia = 1.4159650959661E-15
@@ -531,325 +965,12 @@ def augment_land(lci_land):
     return lci_land
 
 
-def land_annual_permanent(lci_land, exio3_11, exio3_19, row_region_mappings, exiobase_grouping_patterns, store_matrix=False, store_cfs=False):
-    print("Calculating PDF/€ land use (annual and permanent crops)")
-
-    # Get EXIOBASE regions
-    exio_regions = exio3_19.get_regions()
-    
-    # Define row regions (rest of world regions in EXIOBASE)
-    row_regions = {"WA": "Asia and pacific", "WE": "Europe", "WF": "Africa", "WM": "Middle east", "WL": "America"}
-    exio_regions_without_row = [region for region in exio_regions if region not in row_regions.keys()]
-    
-    if (len(get_missing_from_lci(exio_regions_without_row, lci_land)) > 0):
-        print("Missing from LCI land use:", get_missing_from_lci(exio_regions_without_row, lci_land))
-        lci_land = augment_land(lci_land)
-        assert len(get_missing_from_lci(exio_regions_without_row, lci_land)) == 0, "There are still missing regions in land use after augmentation"
-    
-    # Get row regions
-    row_land = get_row_regions(lci_land["Country_Code"].tolist(), exio_regions)
-    print("Row regions for land use:", row_land)
-    
-    # Annual / permanent crops
-    groups = exio3_11.satellite.get_index(
-        as_dict=True,
-        grouping_pattern=exiobase_grouping_patterns["land_annual_permanent"]
-    )
-
-    exio3_11.satellite_agg = exio3_11.satellite.copy(new_name="Aggregated land stress - annual and permanent")
-
-    for df_name, df in zip(exio3_11.satellite_agg.get_DataFrame(data=False, with_unit=True, with_population=False),
-    exio3_11.satellite_agg.get_DataFrame(data=True, with_unit=True, with_population=False)):
-        if df_name == "unit":
-            exio3_11.satellite_agg.__dict__[df_name] = df.groupby(groups).apply(lambda x: " & ".join(x.unit.unique()))
-        else:
-            exio3_11.satellite_agg.__dict__[df_name] = df.groupby(groups).sum()
-
-    groups = exio3_19.satellite.get_index(
-        as_dict=True,
-        grouping_pattern=exiobase_grouping_patterns["land_annual_permanent"]
-    )
-
-    exio3_19.satellite_agg = exio3_19.satellite.copy(new_name="Aggregated land stress - annual and permanent")
-
-    for df_name, df in zip(exio3_19.satellite_agg.get_DataFrame(data=False, with_unit=True, with_population=False),
-    exio3_19.satellite_agg.get_DataFrame(data=True, with_unit=True, with_population=False)):
-        if df_name == "unit":
-            exio3_19.satellite_agg.__dict__[df_name] = df.groupby(groups).apply(lambda x: " & ".join(x.unit.unique()))
-        else:
-            exio3_19.satellite_agg.__dict__[df_name] = df.groupby(groups).sum()
-
-    annual_diag = exio3_11.satellite_agg.diag_stressor("Land stress - annual and permanent")
-    D_cba_annual = calculate_cba(exio3_11, annual_diag, exio3_11.L)
-    dr_s_annual = dr_s(D_cba_annual)
-    dr_u_annual = dr_u(dr_s_annual, row_region_mappings, row_land)
-    dr_f_annual = dr_f(exio3_19.satellite_agg, dr_u_annual, 'Land stress - annual and permanent')
-    
-    # Save matrix if enabled
-    if store_matrix:
-        import pickle
-        with open("pipeline/output/matrices/pdf-matrix-land-annual-permanent-crops.pkl", "wb") as f:
-            pickle.dump(dr_f_annual, f)
-
-    # Save CFs if enabled
-    if store_cfs:
-        # Store permanent crops CFs
-        cf_permanent = lci_land[["Country_Code", "Permanent crops Median", "Augmented"]].copy()
-        cf_permanent.columns = ["Country_Code", "CF_Value", "Augmented"]
-        cf_permanent.to_csv("pipeline/output/cfs/cfs-land-permanent.csv", index=False)
-    
-    land_annual_permanent_crops = pdf(lci_land, dr_f_annual, "Permanent crops Median")
-
-    return land_annual_permanent_crops
-
-
-def land_annual(lci_land, exio3_11, exio3_19, row_region_mappings, exiobase_grouping_patterns, store_matrix=False, store_cfs=False):
-    print("Calculating PDF/€ land use (annual crops)")
-
-    # Get EXIOBASE regions
-    exio_regions = exio3_19.get_regions()
-    
-    # Define row regions (rest of world regions in EXIOBASE)
-    row_regions = {"WA": "Asia and pacific", "WE": "Europe", "WF": "Africa", "WM": "Middle east", "WL": "America"}
-    exio_regions_without_row = [region for region in exio_regions if region not in row_regions.keys()]
-    
-    if (len(get_missing_from_lci(exio_regions_without_row, lci_land)) > 0):
-        print("Missing from LCI land use:", get_missing_from_lci(exio_regions_without_row, lci_land))
-        lci_land = augment_land(lci_land)
-        assert len(get_missing_from_lci(exio_regions_without_row, lci_land)) == 0, "There are still missing regions in land use after augmentation"
-    
-    # Get row regions
-    row_land = get_row_regions(lci_land["Country_Code"].tolist(), exio_regions)
-    print("Row regions for land use:", row_land)
-    
-    # Annual crops
-    groups = exio3_11.satellite.get_index(
-        as_dict=True,
-        grouping_pattern=exiobase_grouping_patterns["land_annual"]
-    )
-
-    exio3_11.satellite_agg = exio3_11.satellite.copy(new_name="Aggregated land stress - annual crops")
-
-    for df_name, df in zip(exio3_11.satellite_agg.get_DataFrame(data=False, with_unit=True, with_population=False),
-    exio3_11.satellite_agg.get_DataFrame(data=True, with_unit=True, with_population=False)):
-        if df_name == "unit":
-            exio3_11.satellite_agg.__dict__[df_name] = df.groupby(groups).apply(lambda x: " & ".join(x.unit.unique()))
-        else:
-            exio3_11.satellite_agg.__dict__[df_name] = df.groupby(groups).sum()
-
-    groups = exio3_19.satellite.get_index(
-        as_dict=True,
-        grouping_pattern=exiobase_grouping_patterns["land_annual"]
-    )
-
-    exio3_19.satellite_agg = exio3_19.satellite.copy(new_name="Aggregated land stress - annual crops")
-
-    for df_name, df in zip(exio3_19.satellite_agg.get_DataFrame(data=False, with_unit=True, with_population=False),
-    exio3_19.satellite_agg.get_DataFrame(data=True, with_unit=True, with_population=False)):
-        if df_name == "unit":
-            exio3_19.satellite_agg.__dict__[df_name] = df.groupby(groups).apply(lambda x: " & ".join(x.unit.unique()))
-        else:
-            exio3_19.satellite_agg.__dict__[df_name] = df.groupby(groups).sum()
-    
-    annual_diag = exio3_11.satellite_agg.diag_stressor("Land stress - annual crops")
-    D_cba_annual = calculate_cba(exio3_11, annual_diag, exio3_11.L)
-    dr_s_annual = dr_s(D_cba_annual)
-    dr_u_annual = dr_u(dr_s_annual, row_region_mappings, row_land)
-    dr_f_annual = dr_f(exio3_19.satellite_agg, dr_u_annual, "Land stress - annual crops")
-    
-    # Save matrix if enabled
-    if store_matrix:
-        import pickle
-        with open("pipeline/output/matrices/pdf-matrix-land-annual-crops.pkl", "wb") as f:
-            pickle.dump(dr_f_annual, f)
-
-    # Save CFs if enabled
-    if store_cfs:
-        # Store annual crops CFs
-        cf_annual = lci_land[["Country_Code", "Annual crops Median", "Augmented"]].copy()
-        cf_annual.columns = ["Country_Code", "CF_Value", "Augmented"]
-        cf_annual.to_csv("pipeline/output/cfs/cfs-land-annual.csv", index=False)
-    
-    land_annual_crops = pdf(lci_land, dr_f_annual, "Annual crops Median")
-
-    return land_annual_crops
-
-
-def land_pasture(lci_land, exio3_11, exio3_19, row_region_mappings, exiobase_grouping_patterns, store_matrix=False, store_cfs=False):
-    print("Calculating PDF/€ land use (pasture)")
-
-    # Get EXIOBASE regions
-    exio_regions = exio3_19.get_regions()
-    
-    # Define row regions (rest of world regions in EXIOBASE)
-    row_regions = {"WA": "Asia and pacific", "WE": "Europe", "WF": "Africa", "WM": "Middle east", "WL": "America"}
-    exio_regions_without_row = [region for region in exio_regions if region not in row_regions.keys()]
-    
-    if (len(get_missing_from_lci(exio_regions_without_row, lci_land)) > 0):
-        print("Missing from LCI land use:", get_missing_from_lci(exio_regions_without_row, lci_land))
-        lci_land = augment_land(lci_land)
-        assert len(get_missing_from_lci(exio_regions_without_row, lci_land)) == 0, "There are still missing regions in land use after augmentation"
-    
-    # Get row regions
-    row_land = get_row_regions(lci_land["Country_Code"].tolist(), exio_regions)
-    print("Row regions for land use:", row_land)
-
-    # Pasture
-    groups = exio3_11.satellite.get_index(
-        as_dict=True,
-        grouping_pattern=exiobase_grouping_patterns["land_pasture"]
-    )
-
-    exio3_11.satellite_agg = exio3_11.satellite.copy(new_name="Aggregated land stress - pasture")
-
-    for df_name, df in zip(exio3_11.satellite_agg.get_DataFrame(data=False, with_unit=True, with_population=False),
-    exio3_11.satellite_agg.get_DataFrame(data=True, with_unit=True, with_population=False)):
-        if df_name == "unit":
-            exio3_11.satellite_agg.__dict__[df_name] = df.groupby(groups).apply(lambda x: " & ".join(x.unit.unique()))
-        else:
-            exio3_11.satellite_agg.__dict__[df_name] = df.groupby(groups).sum()
-
-    groups = exio3_19.satellite.get_index(
-        as_dict=True,
-        grouping_pattern=exiobase_grouping_patterns["land_pasture"]
-    )
-
-    exio3_19.satellite_agg = exio3_19.satellite.copy(new_name="Aggregated land stress - pasture")
-
-    for df_name, df in zip(exio3_19.satellite_agg.get_DataFrame(data=False, with_unit=True, with_population=False),
-    exio3_19.satellite_agg.get_DataFrame(data=True, with_unit=True, with_population=False)):
-        if df_name == "unit":
-            exio3_19.satellite_agg.__dict__[df_name] = df.groupby(groups).apply(lambda x: " & ".join(x.unit.unique()))
-        else:
-            exio3_19.satellite_agg.__dict__[df_name] = df.groupby(groups).sum()
-    
-    pasture_diag = exio3_11.satellite_agg.diag_stressor("Land stress - pasture")
-    D_cba_pasture = calculate_cba(exio3_11, pasture_diag, exio3_11.L)
-    dr_s_pasture = dr_s(D_cba_pasture)
-    dr_u_pasture = dr_u(dr_s_pasture, row_region_mappings, row_land)
-    dr_f_pasture = dr_f(exio3_19.satellite_agg, dr_u_pasture, "Land stress - pasture")
-    
-    # Save matrix if enabled
-    if store_matrix:
-        import pickle
-        with open("pipeline/output/matrices/pdf-matrix-land-pasture.pkl", "wb") as f:
-            pickle.dump(dr_f_pasture, f)
-
-    # Save CFs if enabled
-    if store_cfs:
-        # Store pasture CFs
-        cf_pasture = lci_land[["Country_Code", "Pasture Median", "Augmented"]].copy()
-        cf_pasture.columns = ["Country_Code", "CF_Value", "Augmented"]
-        cf_pasture.to_csv("pipeline/output/cfs/cfs-land-pasture.csv", index=False)
-    
-    land_pasture = pdf(lci_land, dr_f_pasture, "Pasture Median")
-
-    return land_pasture
-
-
-def land_forestry(lci_land, exio3_11, exio3_19, row_region_mappings, store_matrix=False, store_cfs=False):
-    print("Calculating PDF/€ land use (forestry)")
-
-    # Get EXIOBASE regions
-    exio_regions = exio3_19.get_regions()
-    
-    # Define row regions (rest of world regions in EXIOBASE)
-    row_regions = {"WA": "Asia and pacific", "WE": "Europe", "WF": "Africa", "WM": "Middle east", "WL": "America"}
-    exio_regions_without_row = [region for region in exio_regions if region not in row_regions.keys()]
-    
-    if (len(get_missing_from_lci(exio_regions_without_row, lci_land)) > 0):
-        print("Missing from LCI land use:", get_missing_from_lci(exio_regions_without_row, lci_land))
-        lci_land = augment_land(lci_land)
-        assert len(get_missing_from_lci(exio_regions_without_row, lci_land)) == 0, "There are still missing regions in land use after augmentation"
-    
-    # Get row regions
-    row_land = get_row_regions(lci_land["Country_Code"].tolist(), exio_regions)
-    print("Row regions for land use:", row_land)
-
-    # Forestry
-    forestry_diag = exio3_11.satellite.diag_stressor(("Forest area - Forestry"))
-    D_cba_forestry = calculate_cba(exio3_11, forestry_diag, exio3_11.L)
-    dr_s_forestry = dr_s(D_cba_forestry)
-    dr_u_forestry = dr_u(dr_s_forestry, row_region_mappings, row_land)
-    dr_f_forestry = dr_f(exio3_19.satellite, dr_u_forestry, "Forest area - Forestry")
-    
-    # Save matrix if enabled
-    if store_matrix:
-        import pickle
-        with open("pipeline/output/matrices/pdf-matrix-land-forestry.pkl", "wb") as f:
-            pickle.dump(dr_f_forestry, f)
-
-    # Save CFs if enabled
-    if store_cfs:
-        # Store forestry CFs
-        cf_forestry = lci_land[["Country_Code", "Forestry Median", "Augmented"]].copy()
-        cf_forestry.columns = ["Country_Code", "CF_Value", "Augmented"]
-        cf_forestry.to_csv("pipeline/output/cfs/cfs-land-forestry.csv", index=False)
-    
-    land_forestry = pdf(lci_land, dr_f_forestry, "Forestry Median")
-
-    return land_forestry
-
-
-def land_other(lci_land, exio3_11, exio3_19, row_region_mappings, store_matrix=False, store_cfs=False):
-    print("Calculating PDF/€ land use (other/urban)")
-
-    # Get EXIOBASE regions
-    exio_regions = exio3_19.get_regions()
-    
-    # Define row regions (rest of world regions in EXIOBASE)
-    row_regions = {"WA": "Asia and pacific", "WE": "Europe", "WF": "Africa", "WM": "Middle east", "WL": "America"}
-    exio_regions_without_row = [region for region in exio_regions if region not in row_regions.keys()]
-    
-    if (len(get_missing_from_lci(exio_regions_without_row, lci_land)) > 0):
-        print("Missing from LCI land use:", get_missing_from_lci(exio_regions_without_row, lci_land))
-        lci_land = augment_land(lci_land)
-        assert len(get_missing_from_lci(exio_regions_without_row, lci_land)) == 0, "There are still missing regions in land use after augmentation"
-    
-    # Get row regions
-    row_land = get_row_regions(lci_land["Country_Code"].tolist(), exio_regions)
-    print("Row regions for land use:", row_land)
-
-    # Other land use (urban)
-    other_diag = exio3_11.satellite.diag_stressor(("Other land Use: Total"))
-    D_cba_other = calculate_cba(exio3_11, other_diag, exio3_11.L)
-    dr_s_other = dr_s(D_cba_other)
-    dr_u_other = dr_u(dr_s_other, row_region_mappings, row_land)
-    dr_f_other = dr_f(exio3_19.satellite, dr_u_other, "Other land Use: Total")
-    
-    # Save matrix if enabled
-    if store_matrix:
-        import pickle
-        with open("pipeline/output/matrices/pdf-matrix-land-other.pkl", "wb") as f:
-            pickle.dump(dr_f_other, f)
-
-    # Save CFs if enabled
-    if store_cfs:
-        # Store urban/other land use CFs
-        cf_urban = lci_land[["Country_Code", "Urban Median", "Augmented"]].copy()
-        cf_urban.columns = ["Country_Code", "CF_Value", "Augmented"]
-        cf_urban.to_csv("pipeline/output/cfs/cfs-land-urban.csv", index=False)
-    
-    land_other = pdf(lci_land, dr_f_other, "Urban Median")
-
-    return land_other
-
-
-def climate_change(lci_climate, exio3_19, exiobase_grouping_patterns, store_cfs=False):
+def climate_change(lci_climate, exio3_19, exiobase_grouping_patterns, store_cfs=False, output_dir="pipeline/output"):
     print("Calculating PDF/€ climate change")
 
     # TODO: this grouping should be checked
-    groups = exio3_19.satellite.get_index(as_dict=True, grouping_pattern=exiobase_grouping_patterns["climate_change"])
-
-    satellite_agg = exio3_19.satellite.copy()
-
-    for df_name, df in zip(satellite_agg.get_DataFrame(data=False, with_unit=True, with_population=False),
-    satellite_agg.get_DataFrame(data=True, with_unit=True, with_population=False)):
-        if df_name == "unit":
-            satellite_agg.__dict__[df_name] = df.groupby(groups).apply(lambda x: " & ".join(x.unit.unique()))
-        else:
-            satellite_agg.__dict__[df_name] = df.groupby(groups).sum()
-
+    with stage("aggregate_satellite", grouping_pattern="climate_change"):
+        satellite_agg = aggregate_satellite(exio3_19.satellite, exiobase_grouping_patterns["climate_change"], exio3_19.satellite.name)
 
     # TODO: check if using 'all effects 100yrs' is correct
     # calculate aquatic factors
@@ -877,7 +998,7 @@ def climate_change(lci_climate, exio3_19, exiobase_grouping_patterns, store_cfs=
                 'CF_Value': [lci_climate['All effects 100yrs (aquatic)'].values[i]],
                 'Augmented': ['original']
             })
-            cf_data.to_csv(f"pipeline/output/cfs/cfs-climate-aquatic-{substance.lower()}.csv", index=False)
+            cf_data.to_csv(f"{output_dir}/cfs/cfs-climate-aquatic-{substance.lower()}.csv", index=False)
         
         # Terrestrial CFs
         for i, substance in enumerate(substances):
@@ -886,7 +1007,7 @@ def climate_change(lci_climate, exio3_19, exiobase_grouping_patterns, store_cfs=
                 'CF_Value': [lci_climate['All effects 100yrs (terrestrial)'].values[i]],
                 'Augmented': ['original']
             })
-            cf_data.to_csv(f"pipeline/output/cfs/cfs-climate-terrestrial-{substance.lower()}.csv", index=False)
+            cf_data.to_csv(f"{output_dir}/cfs/cfs-climate-terrestrial-{substance.lower()}.csv", index=False)
     
     return climate_aquatic, climate_terrestrial
 
@@ -964,275 +1085,1088 @@ def augment_water(lci_water):
     return lci_water
 
 
-def water_consumption(lci_water, exio3_19, exio3_11, row_region_mappings, exiobase_grouping_patterns, store_matrix=False, store_cfs=False):
-    print("Calculating PDF/€ water consumption")
-    
-    # Get EXIOBASE regions
-    exio_regions = exio3_19.get_regions()
-    
-    # Define row regions (rest of world regions in EXIOBASE)
-    row_regions = {"WA": "Asia and pacific", "WE": "Europe", "WF": "Africa", "WM": "Middle east", "WL": "America"}
-    exio_regions_without_row = [region for region in exio_regions if region not in row_regions.keys()]
-    
-    # Check if water data needs augmentation
-    if len(get_missing_from_lci(exio_regions_without_row, lci_water)) > 0:
-        print("Missing from LCI water use:", get_missing_from_lci(exio_regions_without_row, lci_water))
-        lci_water = augment_water(lci_water)
-        assert len(get_missing_from_lci(exio_regions_without_row, lci_water)) == 0, "There are still missing regions in water use after augmentation"
-    
-    # Get row regions for water consumption
-    row_water = get_row_regions(lci_water["Country_Code"].tolist(), exio_regions)
-    print("Row regions for water consumption:", row_water)
-    
-    # Aggregate all blue water consumption related drivers
-    groups = exio3_11.satellite.get_index(as_dict=True, grouping_pattern=exiobase_grouping_patterns["water_consumption"])
-    
-    exio3_11.satellite_agg = exio3_11.satellite.copy(new_name="Aggregated blue water consumption accounts")
-    
-    for df_name, df in zip(exio3_11.satellite_agg.get_DataFrame(data=False, with_unit=True, with_population=False),
-    exio3_11.satellite_agg.get_DataFrame(data=True, with_unit=True, with_population=False)):
-        if df_name == "unit":
-            exio3_11.satellite_agg.__dict__[df_name] = df.groupby(groups).apply(lambda x: " & ".join(x.unit.unique()))
-        else:
-            exio3_11.satellite_agg.__dict__[df_name] = df.groupby(groups).sum()
-    
-    # Diagonalize aggregated blue water consumption
-    water_diag = exio3_11.satellite_agg.diag_stressor(("Water Consumption Blue – Total"))
+# continental averages for the EXIOBASE regions missing from an LCI dataset, by name of the dataset in LCI_FILES
+LCI_AUGMENTATIONS = {
+    "acidification": augment_acid,
+    "freshwater_eutrophication": augment_freshwater,
+    "marine_eutrophication": augment_marine,
+    "land": augment_land,
+    "water": augment_water,
+}
 
-    D_cba_water = calculate_cba(exio3_11, water_diag, exio3_11.L)
-    dr_s_water = dr_s(D_cba_water)
-    dr_u_water = dr_u(dr_s_water, row_region_mappings, row_water)
-    
-    # Aggregate water consumption drivers for 2019 data
-    groups_19 = exio3_19.satellite.get_index(as_dict=True, grouping_pattern=exiobase_grouping_patterns["water_consumption"])
-    
-    exio3_19.satellite_agg = exio3_19.satellite.copy(new_name="Aggregated blue water consumption accounts")
-    
-    for df_name, df in zip(exio3_19.satellite_agg.get_DataFrame(data=False, with_unit=True, with_population=False),
-    exio3_19.satellite_agg.get_DataFrame(data=True, with_unit=True, with_population=False)):
-        if df_name == "unit":
-            exio3_19.satellite_agg.__dict__[df_name] = df.groupby(groups_19).apply(lambda x: " & ".join(x.unit.unique()))
-        else:
-            exio3_19.satellite_agg.__dict__[df_name] = df.groupby(groups_19).sum()
-    
-    # Calculate dr_f manually since we need to use aggregated satellite data
-    print("Calculating dr_f for Water Consumption Blue – Total")
-    dr_f_water = dr_f(exio3_19.satellite_agg, dr_u_water, "Water Consumption Blue – Total")
-    
-    # Save matrix if enabled
-    if store_matrix:
-        import pickle
-        with open("pipeline/output/matrices/pdf-matrix-water-consumption.pkl", "wb") as f:
-            pickle.dump(dr_f_water, f)
 
-    # Save CFs if enabled
-    if store_cfs:
-        # Store water consumption CFs
-        cf_water = lci_water[["Country_Code", "CF all effects  [PDF·yr/m3]", "Augmented"]].copy()
-        cf_water.columns = ["Country_Code", "CF_Value", "Augmented"]
-        cf_water.to_csv("pipeline/output/cfs/cfs-water-consumption.csv", index=False)
-    
-    water_total = pdf(lci_water, dr_f_water, "CF all effects  [PDF·yr/m3]")
+def prepare_lci(lci_name, lci, exio_regions):
+    """
+    Augment an LCI dataset with the EXIOBASE regions it is missing and get its rest of the world countries.
+    This is done once per dataset and shared by all impact categories using the dataset.
+    """
+    exio_regions_without_row = [region for region in exio_regions if region not in ROW_REGIONS.keys()]
+    missing = get_missing_from_lci(exio_regions_without_row, lci)
+    if len(missing) > 0:
+        print(f"Missing from LCI {lci_name}:", missing)
+        if lci_name in LCI_AUGMENTATIONS:
+            lci = LCI_AUGMENTATIONS[lci_name](lci)
+            assert len(get_missing_from_lci(exio_regions_without_row, lci)) == 0, f"There are still missing regions in {lci_name} after augmentation"
 
-    return water_total
+    row_countries = get_row_regions(lci["Country_Code"].tolist(), exio_regions)
+    print(f"Row regions for {lci_name}:", row_countries)
+    return lci, row_countries
 
 
-def marine_eutrophication(lci_marine, exio3_19, exio3_11, row_region_mappings, store_matrix=False, store_cfs=False):
-    print("Calculating PDF/€ marine eutrophication")
-    
-    # Get EXIOBASE regions
-    exio_regions = exio3_19.get_regions()
-    
-    # Define row regions (rest of world regions in EXIOBASE)
-    row_regions = {"WA": "Asia and pacific", "WE": "Europe", "WF": "Africa", "WM": "Middle east", "WL": "America"}
-    exio_regions_without_row = [region for region in exio_regions if region not in row_regions.keys()]
-    
-    # Check if marine data needs augmentation
-    if len(get_missing_from_lci(exio_regions_without_row, lci_marine)) > 0:
-        print("Missing from LCI marine eutrophication:", get_missing_from_lci(exio_regions_without_row, lci_marine))
-        lci_marine = augment_marine(lci_marine)
-        assert len(get_missing_from_lci(exio_regions_without_row, lci_marine)) == 0, "There are still missing regions in marine eutrophication after augmentation"
-    
-    # Get row regions for marine eutrophication
-    row_marine = get_row_regions(lci_marine["Country_Code"].tolist(), exio_regions)
-    print("Row regions for marine eutrophication:", row_marine)
-    
-    # Calculate for nitrogen water emissions
-    n_diag = exio3_11.satellite.diag_stressor(("N - agriculture - water"))
+# draws, percentiles of the bands and seed of the uncertainty mode, see calculate_stressors
+Uncertainty = namedtuple("Uncertainty", ["draws", "percentiles", "seed"])
 
-    D_cba_n = calculate_cba(exio3_11, n_diag, exio3_11.L)
-    dr_s_n = dr_s(D_cba_n)
-    dr_u_n = dr_u(dr_s_n, row_region_mappings, row_marine)
-    dr_f_n = dr_f(exio3_19.satellite, dr_u_n, "N - agriculture - water")
-    
-    # Save matrix if enabled
-    if store_matrix:
-        import pickle
-        with open("pipeline/output/matrices/pdf-matrix-marine-eutrophication.pkl", "wb") as f:
-            pickle.dump(dr_f_n, f)
+
+def calculate_stressors(stressors, lcis, consumption, exio3_11, satellite_11, satellite_19, store_matrix=False, store_cfs=False, output_dir="pipeline/output", matrix_dtype="float64", matrix_encoding="dense", sparse_threshold=0.5, reference=None, deviations=None, attribution_paths=None, rebuild_attribution=False, uncertainty=None, bands=None):
+    """
+    Calculate PDF/€ of the impact categories (entries of impact_categories in the arguments) of the stressors of
+    one satellite (stressor name -> categories of the stressor). The categories of all stressors are calculated
+    in one pass over L·Y with fused_pdf. dr_s, dr_u and dr_f are only built when store_matrix is set, dr_s once
+    per stressor and dr_u and dr_f once per stressor and LCI dataset of its categories.
+    Stressors that are non-zero in fewer rows than sparse_threshold (share of rows) only read those rows of L·Y
+    and their dr_f is built as a sparse matrix.
+    With reference (positions of sampled kept columns, their float64 columns of L·Y) the maximum relative
+    deviation of the PDF/€ of each category from the float64 reference is stored in deviations.
+    With attribution_paths (stressor name -> path) the region_attribution of each stressor is stored there
+    (save_table), or loaded from there without using L·Y if it exists, and the PDF/€ is calculated from it with
+    region_pdf.
+    With uncertainty (see Uncertainty) the region_attribution of every stressor is calculated and the pdf_bands
+    of each category over uncertainty.draws draws of its CFs are stored in bands.
+    lcis maps the LCI datasets to the augmented LCI data and the region_expansion of the dataset, consumption
+    are the consumption_columns of L·Y.
+    Returns the PDF/€ by name of the category.
+    """
+    print(f"Calculating PDF/€ {', '.join(category['name'] for categories in stressors.values() for category in categories)}")
+    attribution_paths = attribution_paths or {}
+    # stressors whose PDF/€ is calculated from their region_attribution
+    attributed = set(stressors) if uncertainty is not None else set(attribution_paths)
+    attributions = {}
+    keep_columns, consumption_labels = consumption
 
     # Save CFs if enabled
     if store_cfs:
-        # Store N marine emission CFs
-        cf_n_marine = lci_marine[["Country_Code", "CF for direct N emission to marine system [PDF*yr/kg]", "Augmented"]].copy()
-        cf_n_marine.columns = ["Country_Code", "CF_Value", "Augmented"]
-        cf_n_marine.to_csv("pipeline/output/cfs/cfs-marine-nitrogen.csv", index=False)
-    
-    marine_n = pdf(lci_marine, dr_f_n, "CF for direct N emission to marine system [PDF*yr/kg]")
+        for categories in stressors.values():
+            for category in categories:
+                lci, _ = lcis[category["lci"]]
+                cf = lci[["Country_Code", category["cf"], "Augmented"]].copy()
+                cf.columns = ["Country_Code", "CF_Value", "Augmented"]
+                cf.to_csv(f"{output_dir}/cfs/{category['cfs_output']}", index=False)
+
+    # CFs of the rows of dr_u collapsed to the rows of x_diag
+    weights = {}
+    for stressor_name, categories in stressors.items():
+        columns = []
+        for category in categories:
+            lci, lci_expansion = lcis[category["lci"]]
+            columns.append(collapse_rows(lci_expansion, row_cfs(lci, lci_expansion.index, category["cf"])))
+        weights[stressor_name] = np.column_stack(columns)
+
+    pdf_totals = {}
+    for stressor_name in stressors:
+        attribution_path = attribution_paths.get(stressor_name)
+        if attribution_path is not None and os.path.exists(attribution_path + ".npy") and not rebuild_attribution:
+            print(f"Loading attribution of {stressor_name} from cache {attribution_path}")
+            cache_event("attribution", "hit", os.path.basename(attribution_path))
+            with stage("load_attribution", stressor=stressor_name):
+                attribution = load_table(attribution_path)
+                attributions[stressor_name] = attribution
+                pdf_totals[stressor_name] = region_pdf(exio3_11.x.index, weights[stressor_name], attribution)
+    stressor_names = [stressor_name for stressor_name in stressors if stressor_name not in pdf_totals]
+
+    if stressor_names:
+        # use 2019 impact factors, the rest of the world regions are not consumption regions
+        m = satellite_19.M.loc[stressor_names].drop(list(ROW_REGIONS.keys()), level=0, axis=1).to_numpy()
+        with stage("stressor_intensity", stressors=stressor_names) as record:
+            s = stressor_intensity(exio3_11, satellite_11, stressor_names)
+            stressor_rows_by_name = {stressor_name: stressor_rows(s[k], stressor_name, sparse_threshold) for k, stressor_name in enumerate(stressor_names)}
+            # the pass over L·Y reads the rows of any of the stressors if all of them are sparse
+            rows = None
+            if all(stressor_rows_by_name[stressor_name] is not None for stressor_name in stressor_names):
+                rows = np.flatnonzero(np.any(s != 0, axis=0))
+            record["rows"] = s.shape[1] if rows is None else len(rows)
 
-    return marine_n
+    # Save matrices if enabled
+    for k, stressor_name in enumerate(stressor_names if store_matrix else []):
+        categories = stressors[stressor_name]
+        if stressor_rows_by_name[stressor_name] is not None:
+            dr_f_by_lci = {}
+            for category in categories:
+                if category["lci"] not in dr_f_by_lci:
+                    with stage("sparse_dr_f", stressor=stressor_name, lci=category["lci"]) as record:
+                        dr_f_by_lci[category["lci"]] = sparse_dr_f(exio3_11.x_diag.to_numpy(), s[k], m[k], stressor_rows_by_name[stressor_name], lcis[category["lci"]][1])
+                        record["shape"] = list(dr_f_by_lci[category["lci"]].shape)
+                with stage("save_matrix", category=category["name"]):
+                    save_matrix(dr_f_by_lci[category["lci"]], f"{output_dir}/matrices/pdf-matrix-{category['name']}", matrix_dtype, matrix_encoding)
+            del dr_f_by_lci
+        else:
+            with stage("calculate_cba", stressor=stressor_name) as record:
+                D_cba = calculate_cba(exio3_11, satellite_11, stressor_name)
+                record["shape"] = list(D_cba.shape)
+            with stage("dr_s", stressor=stressor_name):
+                dr_s_stressor = dr_s(D_cba)
+            del D_cba
+            dr_f_by_lci = {}
+            for category in categories:
+                if category["lci"] not in dr_f_by_lci:
+                    with stage("dr_u", stressor=stressor_name, lci=category["lci"]) as record:
+                        dr_u_lci = dr_u(dr_s_stressor, lcis[category["lci"]][1])
+                        record["shape"] = list(dr_u_lci.shape)
+                    with stage("dr_f", stressor=stressor_name, lci=category["lci"]):
+                        dr_f_by_lci[category["lci"]] = dr_f(satellite_19, dr_u_lci, stressor_name)
+                    del dr_u_lci
+                with stage("save_matrix", category=category["name"]):
+                    save_matrix(dr_f_by_lci[category["lci"]], f"{output_dir}/matrices/pdf-matrix-{category['name']}", matrix_dtype, matrix_encoding)
+            del dr_s_stressor, dr_f_by_lci
+
+    if stressor_names:
+        # one pass over L·Y for the attributions to the producing regions of the attributed stressors and the
+        # categories of the other stressors, column k of fused_weights belongs to stressor fused_stressors[k]
+        print(f"Calculating PDF/€ {', '.join(stressor_names)}")
+        indicator, regions = region_indicator(exio3_11.x_diag.index)
+        fused_weights = [indicator if stressor_name in attributed else weights[stressor_name] for stressor_name in stressor_names]
+        fused_stressors = np.repeat(np.arange(len(stressor_names)), [columns.shape[1] for columns in fused_weights])
+        with stage("fused_pdf", stressors=stressor_names) as record:
+            fused_totals = fused_pdf(exio3_11.x_diag.to_numpy(), s, m, np.hstack(fused_weights), keep_columns, rows, stressors=fused_stressors)
+            record["shape"] = list(fused_totals.shape)
+        for k, stressor_name in enumerate(stressor_names):
+            totals = fused_totals[fused_stressors == k]
+            if stressor_name in attributed:
+                attribution = pd.DataFrame(totals, index=regions, columns=consumption_labels)
+                if stressor_name in attribution_paths:
+                    cache_event("attribution", "miss", os.path.basename(attribution_paths[stressor_name]))
+                    save_table(attribution, attribution_paths[stressor_name])
+                attributions[stressor_name] = attribution
+                totals = region_pdf(exio3_11.x_diag.index, weights[stressor_name], attribution)
+            pdf_totals[stressor_name] = totals
+
+    if reference is not None and stressor_names:
+        sample, x_reference = reference
+        reference_stressors = np.repeat(np.arange(len(stressor_names)), [len(stressors[stressor_name]) for stressor_name in stressor_names])
+        reference_totals = fused_pdf(x_reference, s, m[:, sample], np.hstack([weights[stressor_name] for stressor_name in stressor_names]),
+                                     np.arange(len(sample)), rows, stressors=reference_stressors)
+        for k, stressor_name in enumerate(stressor_names):
+            for category, pdf_total, reference_total in zip(stressors[stressor_name], pdf_totals[stressor_name], reference_totals[reference_stressors == k]):
+                deviations[category["name"]] = max_relative_deviation(pdf_total[sample], reference_total)
+
+    # the draws of all categories of a stressor are products with its attribution, L·Y isn't read again
+    if uncertainty is not None:
+        for stressor_name, categories in stressors.items():
+            for category in categories:
+                lci, category_expansion = lcis[category["lci"]]
+                # the draws of a category don't depend on the order in which the categories are calculated
+                rng = np.random.default_rng([uncertainty.seed, int(hashlib.sha256(category["name"].encode()).hexdigest()[:15], 16)])
+                percentile_columns = cf_percentiles(lci, category["cf"], category.get("cf_percentiles"))
+                with stage("pdf_bands", category=category["name"], draws=uncertainty.draws):
+                    region_draws = region_cf_draws(lci, category_expansion, exio3_11.x.index, attributions[stressor_name].index, category["cf"],
+                                                   percentile_columns, uncertainty.draws, rng)
+                    bands[category["name"]] = pdf_bands(region_draws, attributions[stressor_name], uncertainty.percentiles)
+    return {category["name"]: pd.Series(pdf_total, index=consumption_labels)
+            for stressor_name, categories in stressors.items() for category, pdf_total in zip(categories, pdf_totals[stressor_name])}
+
+
+def stage_key(*parts):
+    """
+    Cache key of a stage from its upstream keys and the slice of the configuration it depends on.
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
 
 
-def freshwater_eutrophication(lci_freshwater, exio3_19, exio3_11, row_region_mappings, store_matrix=False, store_cfs=False):
-    print("Calculating PDF/€ freshwater eutrophication")
-    
-    # Get EXIOBASE regions
-    exio_regions = exio3_19.get_regions()
-    
-    # Define row regions (rest of world regions in EXIOBASE)
-    row_regions = {"WA": "Asia and pacific", "WE": "Europe", "WF": "Africa", "WM": "Middle east", "WL": "America"}
-    exio_regions_without_row = [region for region in exio_regions if region not in row_regions.keys()]
-    
-    # Check if freshwater data needs augmentation
-    if len(get_missing_from_lci(exio_regions_without_row, lci_freshwater)) > 0:
-        print("Missing from LCI freshwater eutrophication:", get_missing_from_lci(exio_regions_without_row, lci_freshwater))
-        lci_freshwater = augment_freshwater(lci_freshwater)
-        assert len(get_missing_from_lci(exio_regions_without_row, lci_freshwater)) == 0, "There are still missing regions in freshwater eutrophication after augmentation"
-    
-    # Get row regions for freshwater eutrophication
-    row_freshwater = get_row_regions(lci_freshwater["Country_Code"].tolist(), exio_regions)
-    print("Row regions for freshwater eutrophication:", row_freshwater)
-    
-    # Calculate for both phosphorus water and soil emissions
-    p_water_diag = exio3_11.satellite.diag_stressor(("P - agriculture - water"))
-    p_soil_diag = exio3_11.satellite.diag_stressor(("P - agriculture - soil"))
+def cache_event(stage_name, status, key=None):
+    """
+    Record the status ("hit", "miss" or "skipped") of a cached stage for the cache report of the run.
+    """
+    with CACHE_EVENTS_LOCK:
+        CACHE_EVENTS.append({"stage": stage_name, "status": status, "key": key})
 
-    D_cba_p_water = calculate_cba(exio3_11, p_water_diag, exio3_11.L)
-    D_cba_p_soil = calculate_cba(exio3_11, p_soil_diag, exio3_11.L)
-    
-    dr_s_p_water = dr_s(D_cba_p_water)
-    dr_s_p_soil = dr_s(D_cba_p_soil)
-    
-    dr_u_p_water = dr_u(dr_s_p_water, row_region_mappings, row_freshwater)
-    dr_u_p_soil = dr_u(dr_s_p_soil, row_region_mappings, row_freshwater)
-    
-    dr_f_p_water = dr_f(exio3_19.satellite, dr_u_p_water, "P - agriculture - water")
-    dr_f_p_soil = dr_f(exio3_19.satellite, dr_u_p_soil, "P - agriculture - soil")
-    
-    # Save matrices if enabled
-    if store_matrix:
-        import pickle
-        with open("pipeline/output/matrices/pdf-matrix-freshwater-eutrophication-water.pkl", "wb") as f:
-            pickle.dump(dr_f_p_water, f)
-        with open("pipeline/output/matrices/pdf-matrix-freshwater-eutrophication-soil.pkl", "wb") as f:
-            pickle.dump(dr_f_p_soil, f)
 
-    # Save CFs if enabled
-    if store_cfs:
-        # Store P water emission CFs
-        cf_p_water = lci_freshwater[["Country_Code", "CF for P emissions to water [PDFyr/kg]", "Augmented"]].copy()
-        cf_p_water.columns = ["Country_Code", "CF_Value", "Augmented"]
-        cf_p_water.to_csv("pipeline/output/cfs/cfs-freshwater-water.csv", index=False)
-        
-        # Store P soil emission CFs
-        cf_p_soil = lci_freshwater[["Country_Code", "CF for P emissions to soil [PDFyr/kg]", "Augmented"]].copy()
-        cf_p_soil.columns = ["Country_Code", "CF_Value", "Augmented"]
-        cf_p_soil.to_csv("pipeline/output/cfs/cfs-freshwater-soil.csv", index=False)
-    
-    freshwater_p_water = pdf(lci_freshwater, dr_f_p_water, "CF for P emissions to water [PDFyr/kg]")
-    freshwater_p_soil = pdf(lci_freshwater, dr_f_p_soil, "CF for P emissions to soil [PDFyr/kg]")
+def cache_report():
+    """
+    Count of the statuses of each cached stage of the run and the events, in the order of the stages.
+    """
+    summary = {}
+    for event in CACHE_EVENTS:
+        counts = summary.setdefault(event["stage"], {})
+        counts[event["status"]] = counts.get(event["status"], 0) + 1
+    return {"summary": summary, "events": list(CACHE_EVENTS)}
+
+
+def file_sha256(path, cache_dir=None):
+    """
+    SHA-256 checksum of a file. If cache_dir is given, checksums are remembered in cache_dir/checksums.json
+    by absolute path, size and modification time so that unchanged multi-GB zips are hashed only once.
+    """
+    stat = os.stat(path)
+    signature = [stat.st_size, stat.st_mtime_ns]
+    checksums = {}
+    checksums_path = os.path.join(cache_dir, "checksums.json") if cache_dir else None
+    if checksums_path and os.path.exists(checksums_path):
+        with open(checksums_path, "r") as f:
+            checksums = json.load(f)
+    known = checksums.get(os.path.abspath(path))
+    if known and known["signature"] == signature:
+        return known["sha256"]
+
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(16 * 1024 * 1024), b""):
+            sha256.update(chunk)
+    checksum = sha256.hexdigest()
+
+    if checksums_path:
+        checksums[os.path.abspath(path)] = {"signature": signature, "sha256": checksum}
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{checksums_path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(checksums, f, indent=4)
+        os.replace(tmp_path, checksums_path)
+    return checksum
+
+
+def save_matrix(dr_f, path, dtype="float64", encoding="dense"):
+    """
+    Store a dr_f matrix as path.json (index, columns, dtype and encoding) and memory-mappable arrays:
+    dense: path.npy in column-major order, so that the columns of a consumption region are contiguous
+    sparse: the CSC arrays path.data.npy, path.indices.npy and path.indptr.npy
+    dr_f can be a dense or a sparse DataFrame.
+    """
+    if hasattr(dr_f, "sparse"):
+        matrix = dr_f.sparse.to_coo().astype(dtype)
+    else:
+        import scipy.sparse
+        matrix = dr_f.to_numpy(dtype=dtype) if encoding == "dense" else scipy.sparse.coo_matrix(dr_f.to_numpy(dtype=dtype))
+    if encoding == "sparse":
+        matrix = matrix.tocsc()
+        arrays = {".data.npy": matrix.data, ".indices.npy": matrix.indices, ".indptr.npy": matrix.indptr}
+    else:
+        arrays = {".npy": np.asfortranarray(matrix if isinstance(matrix, np.ndarray) else matrix.toarray())}
+    for suffix, array in arrays.items():
+        np.save(path + suffix, array)
+    with open(path + ".json", "w") as f:
+        json.dump({
+            "dtype": dtype,
+            "encoding": encoding,
+            "shape": list(dr_f.shape),
+            "index_names": list(dr_f.index.names),
+            "index": dr_f.index.tolist(),
+            "column_names": list(dr_f.columns.names),
+            "columns": dr_f.columns.tolist(),
+        }, f)
+
+
+def load_matrix(path, region=None):
+    """
+    Load a matrix stored with save_matrix (path without suffix) as a DataFrame. The arrays are memory-mapped,
+    with region only the columns of that consumption region are read.
+    """
+    with open(path + ".json", "r") as f:
+        meta = json.load(f)
+    index = pd.MultiIndex.from_tuples([tuple(row) for row in meta["index"]], names=meta["index_names"])
+    columns = pd.MultiIndex.from_tuples([tuple(column) for column in meta["columns"]], names=meta["column_names"])
+    if region is None:
+        start, stop = 0, len(columns)
+    else:
+        # the columns of a region are contiguous
+        positions = np.flatnonzero(columns.get_level_values(0) == region)
+        start, stop = positions[0], positions[-1] + 1
+    columns = columns[start:stop]
+
+    if meta["encoding"] == "sparse":
+        import scipy.sparse
+        indptr = np.load(path + ".indptr.npy")[start:stop + 1]
+        data = np.load(path + ".data.npy", mmap_mode="r")[indptr[0]:indptr[-1]]
+        indices = np.load(path + ".indices.npy", mmap_mode="r")[indptr[0]:indptr[-1]]
+        matrix = scipy.sparse.csc_matrix((data, indices, indptr - indptr[0]), shape=(len(index), len(columns)))
+        return pd.DataFrame.sparse.from_spmatrix(matrix, index=index, columns=columns)
+    return pd.DataFrame(np.load(path + ".npy", mmap_mode="r")[:, start:stop], index=index, columns=columns)
+
+
+def save_table(df, path):
+    """
+    Store a DataFrame as path.npy (values) and path.labels.pkl (index and columns).
+    Files are written under temporary names and moved in place so that readers never see partial files.
+    """
+    for suffix, write in ((".npy", lambda f: np.save(f, np.ascontiguousarray(df.to_numpy()))),
+                          (".labels.pkl", lambda f: pickle.dump((df.index, df.columns), f))):
+        tmp_path = f"{path}{suffix}.tmp-{os.getpid()}"
+        with open(tmp_path, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path + suffix)
+
+
+def load_table(path):
+    """
+    Load a DataFrame stored with save_table. Values are memory-mapped read-only instead of read into memory.
+    """
+    values = np.load(path + ".npy", mmap_mode="r")
+    with open(path + ".labels.pkl", "rb") as f:
+        index, columns = pickle.load(f)
+    return pd.DataFrame(values, index=index, columns=columns, copy=False)
 
-    return freshwater_p_water, freshwater_p_soil
 
+# tables of an EXIOBASE system the calculation reads for each role of the system, see exiobase_manifest
+MANIFEST_TABLES = {
+    # the table the shares of the stressors are calculated from (exio_11_path)
+    "share": {"core": ["Z", "Y", "x", "unit"], "satellite": ["F", "unit"]},
+    # the table of the multipliers (exio_19_path), its Z and Y are never used
+    "multiplier": {"core": ["x", "unit"], "satellite": ["F", "M", "unit"]},
+}
 
-def calculate_all(lci_path, exio_19_path, exio_11_path, row_region_mappings, exiobase_grouping_patterns, store_matrix=False, store_cfs=False):
-    lci_climate, lci_ozone, lci_acidification, lci_freshwater_eutrophication, lci_marine_eutrophication, lci_land, lci_water = load_lci(lci_path)
+
+def exiobase_manifest(roles, exiobase_grouping_patterns, impact_categories):
+    """
+    Tables and stressor rows of an EXIOBASE system that the calculation reads for the roles of the system (keys
+    of MANIFEST_TABLES). The stressors are regular expressions matched like in aggregate_satellite: the patterns
+    of the grouping patterns of the impact categories and of climate change and the stressors of the categories
+    without a grouping pattern.
+    """
+    patterns = ["climate_change", *[category["grouping_pattern"] for category in impact_categories if "grouping_pattern" in category]]
+    stressors = {re.escape(category["stressor"]) + "$" for category in impact_categories if "grouping_pattern" not in category}
+    stressors.update(regex for pattern in patterns for regex in exiobase_grouping_patterns[pattern])
+    return {
+        "core": sorted({table for role in roles for table in MANIFEST_TABLES[role]["core"]}),
+        "satellite": sorted({table for role in roles for table in MANIFEST_TABLES[role]["satellite"]}),
+        "stressors": sorted(stressors),
+    }
+
+
+def manifest_covers(manifest, requested):
+    """
+    Whether a system read with manifest has everything of the requested manifest. None is the complete system.
+    """
+    if manifest is None:
+        return True
+    if requested is None:
+        return False
+    return all(set(requested[key]) <= set(manifest[key]) for key in ["core", "satellite", "stressors"])
+
+
+def read_zip_table(zf, member, nr_index_col, nr_header, rows=None):
+    """
+    Read a tab separated table of a zip member as pymrio does. With rows (function of the first index value)
+    the member is streamed line by line and only the header and the matching rows are parsed.
+    """
+    index_col = 0 if nr_index_col == 1 else list(range(nr_index_col))
+    header = 0 if nr_header == 1 else list(range(nr_header))
+    if rows is None:
+        with zf.open(member) as f:
+            return pd.read_csv(f, index_col=index_col, header=header, sep="\t")
+    with zf.open(member) as f:
+        lines = io.TextIOWrapper(f, encoding="utf-8")
+        kept = [next(lines) for _ in range(nr_header)]
+        for i, line in enumerate(lines):
+            fields = line.rstrip("\r\n").split("\t")
+            # a line with only the names of the index columns follows a header of several rows
+            if (i == 0 and nr_header > 1 and not any(fields[nr_index_col:])) or rows(fields[0]):
+                kept.append(line)
+    return pd.read_csv(io.StringIO("".join(kept)), index_col=index_col, header=header, sep="\t")
+
+
+def read_exiobase_zip(exio_path, manifest):
+    """
+    Read the tables and stressor rows of an EXIOBASE 3 zip given by a manifest (see exiobase_manifest) straight
+    from the zip members, located with the file_parameters.json of the system and of its satellite folder.
+    Region codes are cleaned with EXIOBASE_REGION_RENAMES like pymrio.parse_exiobase3 does.
+    The rows of the satellite tables are filtered while they are streamed, so that only the stressors of the
+    manifest are parsed and kept. Returns an IOSystem with the tables of the manifest.
+    """
+    print(f"Reading {', '.join(manifest['core'])} and {len(manifest['stressors'])} stressor patterns of the satellite from {exio_path}")
+    stressor_patterns = [re.compile(pattern) for pattern in manifest["stressors"]]
+    with zipfile.ZipFile(exio_path) as zf:
+        parameters = {}
+        for member in zf.namelist():
+            if os.path.basename(member) == "file_parameters.json":
+                parameters[os.path.dirname(member)] = json.loads(zf.read(member).decode("utf-8"))
+        roots = [folder for folder, content in parameters.items() if content["systemtype"] == "IOSystem"]
+        assert len(roots) == 1, f"Expected one EXIOBASE system in {exio_path}, found {len(roots)}"
+        root = roots[0]
+        satellite_folder = "/".join(part for part in [root, "satellite"] if part)
+
+        def read_tables(folder, names, rows=None):
+            tables = {}
+            for name, file in parameters[folder]["files"].items():
+                name = "F_Y" if name in ("FY", "F_hh") else name
+                if name in names:
+                    member = "/".join(part for part in [folder, file["name"]] if part)
+                    tables[name] = read_zip_table(zf, member, int(file["nr_index_col"]), int(file["nr_header"]), rows)
+            return tables
+
+        core = read_tables(root, manifest["core"])
+        satellite = read_tables(satellite_folder, manifest["satellite"], rows=lambda stressor: any(pattern.match(stressor) for pattern in stressor_patterns))
+    exio3 = pymrio.IOSystem(name=parameters[root].get("name"), **core)
+    exio3.satellite = pymrio.Extension(parameters[satellite_folder].get("name", "satellite"), **satellite)
+    # some zips have ISO3 region codes, which would not match the LCI countries and row region mappings
+    exio3.rename_regions(EXIOBASE_REGION_RENAMES)
+    return exio3
+
+
+def save_exiobase_cache(exio3, cache_path, manifest=None, keep_L=False):
+    """
+    Store a parsed system to the cache entry cache_path, replacing an existing entry. With keep_L the L of the
+    existing entry is kept if the entry has the same Z and x as exio3, e.g. when an entry read with a manifest
+    is read again with more stressors.
+    """
+    tmp_path = f"{cache_path}.tmp-{os.getpid()}"
+    os.makedirs(os.path.join(tmp_path, "core"))
+    os.makedirs(os.path.join(tmp_path, "satellite"))
+    for name in ["Z", "Y", "x"]:
+        if getattr(exio3, name, None) is not None:
+            save_table(getattr(exio3, name), os.path.join(tmp_path, "core", name))
+    for name in ["F", "F_Y", "M"]:
+        df = getattr(exio3.satellite, name, None)
+        if df is not None:
+            save_table(df, os.path.join(tmp_path, "satellite", name))
+    with open(os.path.join(tmp_path, "core", "unit.pkl"), "wb") as f:
+        pickle.dump(exio3.unit, f)
+    with open(os.path.join(tmp_path, "satellite", "unit.pkl"), "wb") as f:
+        pickle.dump(exio3.satellite.unit, f)
+    with open(os.path.join(tmp_path, "system.json"), "w") as f:
+        json.dump({"name": exio3.name, "satellite_name": exio3.satellite.name, "pymrio_version": pymrio.__version__, "manifest": manifest}, f, indent=4)
+
+    if os.path.exists(cache_path):
+        if keep_L and os.path.exists(os.path.join(cache_path, "core", "L.npy")) and all(
+                getattr(exio3, name, None) is not None and os.path.exists(os.path.join(cache_path, "core", name + ".npy"))
+                and load_table(os.path.join(cache_path, "core", name)).equals(getattr(exio3, name)) for name in ["Z", "x"]):
+            for path in glob.glob(os.path.join(cache_path, "core", "L.*")):
+                os.replace(path, os.path.join(tmp_path, "core", os.path.basename(path)))
+        shutil.rmtree(cache_path)
+    os.replace(tmp_path, cache_path)
+
+
+def load_exiobase_cache(cache_path):
+    with open(os.path.join(cache_path, "system.json"), "r") as f:
+        system = json.load(f)
+    with open(os.path.join(cache_path, "core", "unit.pkl"), "rb") as f:
+        unit = pickle.load(f)
+    with open(os.path.join(cache_path, "satellite", "unit.pkl"), "rb") as f:
+        satellite_unit = pickle.load(f)
+
+    # Z and Y are missing from systems read with a manifest without them
+    core = {name: load_table(os.path.join(cache_path, "core", name)) for name in ["Z", "Y", "x"]
+            if os.path.exists(os.path.join(cache_path, "core", name + ".npy"))}
+    exio3 = pymrio.IOSystem(unit=unit, name=system["name"], **core)
+    satellite = {}
+    for name in ["F", "F_Y", "M"]:
+        if os.path.exists(os.path.join(cache_path, "satellite", name + ".npy")):
+            satellite[name] = load_table(os.path.join(cache_path, "satellite", name))
+    exio3.satellite = pymrio.Extension(system["satellite_name"], unit=satellite_unit, **satellite)
+    return exio3
+
+
+def load_exiobase(exio_path, cache_dir=None, rebuild_cache=False, manifest=None):
+    """
+    Parse an EXIOBASE 3 zip, or load it from the cache in cache_dir if it has been parsed before.
+    Cache entries are keyed by the SHA-256 of the zip and the pymrio version. Without cache_dir
+    the zip is always parsed, with rebuild_cache the zip is parsed and the cache entry replaced.
+    With a manifest (see exiobase_manifest) only its tables and stressors are read with read_exiobase_zip,
+    without the complete system is parsed with pymrio. A cache entry is used if it has everything of the
+    manifest, otherwise the zip is read again with the union of both manifests.
+    Returns the system and the path of its cache entry (None without cache_dir).
+    """
+    def read(manifest):
+        return pymrio.parse_exiobase3(path=exio_path) if manifest is None else read_exiobase_zip(exio_path, manifest)
+
+    if cache_dir is None:
+        return read(manifest), None
+
+    cache_path = os.path.join(cache_dir, "exiobase", f"{file_sha256(exio_path, cache_dir)}-pymrio-{pymrio.__version__}")
+    cached_manifest = None
+    if os.path.exists(cache_path):
+        with open(os.path.join(cache_path, "system.json"), "r") as f:
+            cached_manifest = json.load(f).get("manifest")
+        if not rebuild_cache and manifest_covers(cached_manifest, manifest):
+            print(f"Loading {exio_path} from cache {cache_path}")
+            cache_event("parse", "hit", os.path.basename(cache_path))
+            return load_exiobase_cache(cache_path), cache_path
+        if not rebuild_cache and manifest is not None and cached_manifest is not None:
+            manifest = {key: sorted(set(manifest[key]) | set(cached_manifest[key])) for key in manifest}
+
+    cache_event("parse", "miss", os.path.basename(cache_path))
+    exio3 = read(manifest)
+    print(f"Caching {exio_path} to {cache_path}")
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    save_exiobase_cache(exio3, cache_path, manifest, keep_L=not rebuild_cache)
+    return exio3, cache_path
+
+
+def write_parquet(pdfs, categories, path, metadata):
+    """
+    Write the PDF/€ results (name -> Series by region and sector) to one Parquet table with the columns
+    category (LCI dataset), flow (name of the result, pdf-<flow>.csv in CSV output), region, sector and value.
+    metadata of the run is stored as JSON in the schema metadata under the key pdf_calculation.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    print(f"Writing results to {path}")
+    frames = []
+    for name, result in pdfs.items():
+        frames.append(pd.DataFrame({
+            "category": categories[name],
+            "flow": name,
+            "region": result.index.get_level_values(0),
+            "sector": result.index.get_level_values(1),
+            "value": result.to_numpy(dtype=float),
+        }))
+    table = pd.concat(frames, ignore_index=True)
+    # dictionary encode the repeated labels
+    for column in ["category", "flow", "region", "sector"]:
+        table[column] = table[column].astype("category")
+    table = pa.Table.from_pandas(table, preserve_index=False)
+    table = table.replace_schema_metadata({**table.schema.metadata, b"pdf_calculation": json.dumps(metadata).encode()})
+    pq.write_table(table, path + ".tmp", compression="zstd")
+    os.replace(path + ".tmp", path)
+
+
+def enable_instrumentation(profile_dir=None, trace_memory=False):
+    """
+    Record wall and CPU time, peak RSS and the shapes of the results of every stage. With profile_dir each
+    stage is profiled with cProfile to profile_dir/<nr>-<stage>.prof, with trace_memory the peak of the
+    memory allocated by Python during each stage is traced with tracemalloc. Only one profiler can be active,
+    stages starting while another stage is profiled (concurrent tasks) are not profiled.
+    """
+    global INSTRUMENTATION
+    if trace_memory:
+        import tracemalloc
+        tracemalloc.start()
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+    INSTRUMENTATION = {"stages": [], "profile_dir": profile_dir, "trace_memory": trace_memory, "profiling": False,
+                       "lock": threading.Lock(), "wall": time.perf_counter(), "cpu": time.process_time()}
+
+
+def stage(name, **info):
+    """
+    Context manager around a stage of the calculation. Yields the record of the stage, to which the shapes of
+    the results can be added. Does nothing unless enable_instrumentation has been called.
+    """
+    if INSTRUMENTATION is None:
+        return contextlib.nullcontext({})
+    return instrumented_stage(name, info)
+
+
+@contextlib.contextmanager
+def instrumented_stage(name, info):
+    record = {"stage": name, **info, "thread": threading.current_thread().name}
+    profile = None
+    if INSTRUMENTATION["profile_dir"]:
+        with INSTRUMENTATION["lock"]:
+            if not INSTRUMENTATION["profiling"]:
+                import cProfile
+                INSTRUMENTATION["profiling"] = True
+                profile = cProfile.Profile()
+                profile.enable()
+    if INSTRUMENTATION["trace_memory"]:
+        import tracemalloc
+        # stages running concurrently share the peak
+        tracemalloc.reset_peak()
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield record
+    finally:
+        record["wall_seconds"] = time.perf_counter() - wall
+        # CPU time of the process, which includes stages running concurrently and BLAS threads
+        record["cpu_seconds"] = time.process_time() - cpu
+        # ru_maxrss is in kilobytes on Linux
+        record["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        record["peak_rss_delta_mb"] = record["peak_rss_mb"] - peak_rss / 1024
+        if INSTRUMENTATION["trace_memory"]:
+            record["tracemalloc_peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+        with INSTRUMENTATION["lock"]:
+            number = len(INSTRUMENTATION["stages"])
+            INSTRUMENTATION["stages"].append(record)
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(os.path.join(INSTRUMENTATION["profile_dir"], f"{number:03d}-{re.sub(r'[^A-Za-z0-9_.-]+', '_', name)}.prof"))
+            INSTRUMENTATION["profiling"] = False
+
+
+def write_run_report(path, metadata):
+    """
+    Write the records of the stages and the metadata of the run to path as JSON.
+    """
+    report = {
+        **metadata,
+        "wall_seconds": time.perf_counter() - INSTRUMENTATION["wall"],
+        "cpu_seconds": time.process_time() - INSTRUMENTATION["cpu"],
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "stages": INSTRUMENTATION["stages"],
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=4, ensure_ascii=False, default=str)
+    print(f"Run report written to {path}")
+
+
+def load_aggregation(satellite, grouping_pattern, name, cache_path=None, rebuild_cache=False):
+    """
+    aggregate_satellite cached to the directory cache_path, which is keyed by the EXIOBASE cache entry and
+    the grouping pattern. Without cache_path the satellite is aggregated.
+    """
+    if cache_path is None:
+        return aggregate_satellite(satellite, grouping_pattern, name)
+    key = os.path.basename(cache_path)
+    if os.path.exists(os.path.join(cache_path, "unit.pkl")) and not rebuild_cache:
+        cache_event("aggregation", "hit", key)
+        tables = {table: load_table(os.path.join(cache_path, table)) for table in ["F", "M"]
+                  if os.path.exists(os.path.join(cache_path, table + ".npy"))}
+        with open(os.path.join(cache_path, "unit.pkl"), "rb") as f:
+            tables["unit"] = pickle.load(f)
+        return pymrio.Extension(name=name, **tables)
+
+    cache_event("aggregation", "miss", key)
+    satellite_agg = aggregate_satellite(satellite, grouping_pattern, name)
+    tmp_path = f"{cache_path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    os.makedirs(tmp_path)
+    for table in ["F", "M"]:
+        if getattr(satellite_agg, table, None) is not None:
+            save_table(getattr(satellite_agg, table), os.path.join(tmp_path, table))
+    # unit.pkl is written last, it marks the entry as complete
+    with open(os.path.join(tmp_path, "unit.pkl"), "wb") as f:
+        pickle.dump(getattr(satellite_agg, "unit", None), f)
+    if os.path.exists(cache_path):
+        shutil.rmtree(cache_path)
+    os.replace(tmp_path, cache_path)
+    return satellite_agg
+
+
+def aggregate_satellites(exio3_11, exio3_19, exiobase_grouping_patterns, pattern, cache_paths=(None, None), rebuild_cache=False):
+    """
+    Aggregate the satellites of both EXIOBASE systems with the grouping pattern, cached to cache_paths.
+    """
+    with stage("aggregate_satellite", grouping_pattern=pattern):
+        return tuple(load_aggregation(exio3.satellite, exiobase_grouping_patterns[pattern], f"Aggregated {pattern}", cache_path, rebuild_cache)
+                     for exio3, cache_path in zip((exio3_11, exio3_19), cache_paths))
+
+
+def run_tasks(tasks, jobs=1):
+    """
+    Run independent tasks (name -> function without arguments) and return their results by name.
+    With jobs > 1 the tasks run in a pool of jobs threads. Threads share the systems and matrices of the
+    calculation without copying them, and numpy releases the GIL for the heavy array operations.
+    """
+    if jobs <= 1:
+        return {name: task() for name, task in tasks.items()}
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {name: executor.submit(task) for name, task in tasks.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+
+def calculate_all(lci_path, exio_19_path, exio_11_path, row_region_mappings, exiobase_grouping_patterns, impact_categories, store_matrix=False, store_cfs=False, solver="inverse", cache_dir="pipeline/cache", rebuild_cache=False, jobs=1, output_dir="pipeline/output", output_format="csv", matrix_dtype="float64", matrix_encoding="dense", sparse_threshold=0.5, precision="float64", precision_sample=50, uncertainty_draws=0, uncertainty_percentiles=(2.5, 50, 97.5), uncertainty_seed=0, full_parse=False, lci_datasets=None, systems=None):
+    # the LCI datasets and EXIOBASE systems (path -> system and cache path from load_exiobase) can be loaded by
+    # the caller, see calculate_years. The caller (main or calculate_years) also clears the cache events of the run,
+    # so that they include its loading.
+    if lci_datasets is None:
+        with stage("load_lci"):
+            lci_datasets = load_lci(lci_path, cache_dir, rebuild_cache)
+    systems = systems or {}
+    os.makedirs(output_dir, exist_ok=True)
 
     # Create matrices directory if store_matrix is True
     if store_matrix:
-        import os
-        matrices_dir = "pipeline/output/matrices"
+        matrices_dir = f"{output_dir}/matrices"
         os.makedirs(matrices_dir, exist_ok=True)
         print(f"Matrix storage enabled. Matrices will be saved to {matrices_dir}")
 
     # Create CFs directory if store_cfs is True
     if store_cfs:
-        import os
-        cfs_dir = "pipeline/output/cfs"
+        cfs_dir = f"{output_dir}/cfs"
         os.makedirs(cfs_dir, exist_ok=True)
         print(f"CFs storage enabled. Characterization factors will be saved to {cfs_dir}")
 
+    # only the tables and stressors the calculation reads are loaded from the zips, unless full_parse
+    manifests = {}
+    if not full_parse:
+        roles = {exio_19_path: ["multiplier"]}
+        roles.setdefault(exio_11_path, []).append("share")
+        manifests = {path: exiobase_manifest(path_roles, exiobase_grouping_patterns, impact_categories) for path, path_roles in roles.items()}
     # exiobase 2019 is used for impact factors
-    exio3_19 = pymrio.parse_exiobase3(path=exio_19_path)
+    with stage("load_exiobase", path=exio_19_path):
+        exio3_19, exio_19_cache = systems.get(exio_19_path) or load_exiobase(exio_19_path, cache_dir, rebuild_cache, manifests.get(exio_19_path))
     # exiobase 2011 is used for calculating share of stressor for each region-product pair
-    exio3_11 = pymrio.parse_exiobase3(path=exio_11_path)
-    print("Calculating A (exio3_11)")
-    exio3_11.A = pymrio.calc_A(exio3_11.Z, exio3_11.x)
-    print("Calculating L (exio3_11)")
-    exio3_11.L = pymrio.calc_L(exio3_11.A)
+    with stage("load_exiobase", path=exio_11_path) as record:
+        exio3_11, exio_11_cache = systems.get(exio_11_path) or load_exiobase(exio_11_path, cache_dir, rebuild_cache, manifests.get(exio_11_path))
+        record["shape"] = list(exio3_11.Z.shape)
+
+    # Categories of the same stressor share dr_s
+    stressors = {}
+    for category in impact_categories:
+        stressors.setdefault((category.get("grouping_pattern"), category["stressor"]), []).append(category)
+
+    # Stages after parsing are cached by the keys of their upstream stages and the slice of the configuration they
+    # depend on: aggregations by EXIOBASE cache entry and grouping pattern, attributions by the aggregations,
+    # stressor and solver. The row region mappings and CFs only enter the cheap PDF/€ products.
+    grouping_patterns = list(dict.fromkeys(category["grouping_pattern"] for category in impact_categories if "grouping_pattern" in category))
+    aggregation_keys = {None: (os.path.basename(exio_11_cache), os.path.basename(exio_19_cache)) if cache_dir else (None, None)}
+    aggregation_paths = {}
+    if cache_dir:
+        for pattern in grouping_patterns:
+            aggregation_keys[pattern] = tuple(stage_key(os.path.basename(exio_cache), exiobase_grouping_patterns[pattern]) for exio_cache in (exio_11_cache, exio_19_cache))
+            aggregation_paths[pattern] = tuple(os.path.join(cache_dir, "aggregation", key) for key in aggregation_keys[pattern])
+        os.makedirs(os.path.join(cache_dir, "aggregation"), exist_ok=True)
+
+    # The attribution of the stressors to the producing regions doesn't depend on the CFs, so that runs changing
+    # only CFs don't need L·Y
+    attribution_paths = {}
+    cached = []
+    if cache_dir and not store_matrix and precision == "float64":
+        for pattern, stressor_name in stressors:
+            key = stage_key(os.path.basename(exio_11_cache), *aggregation_keys[pattern], stressor_name, solver)
+            attribution_paths[(pattern, stressor_name)] = os.path.join(cache_dir, "attribution", key)
+        os.makedirs(os.path.join(cache_dir, "attribution"), exist_ok=True)
+        cached = [path for path in attribution_paths.values() if os.path.exists(path + ".npy")]
+        print(f"Attribution of {len(cached)} of {len(stressors)} stressors found in cache")
+
+    # L·Y is shared by the consumption based accounts of all stressors
+    dtype = np.float32 if precision == "float32" else np.float64
+    lu = None
+    # float64 reference of a sample of the consumption region-sectors to report the deviation of float32,
+    # calculated before the float64 L is released
+    reference = None
+    deviations = {}
+    if precision == "float32":
+        keep = consumption_columns(x_diag_labels(exio3_11)[1])[0]
+        sample = np.sort(np.random.default_rng(0).choice(len(keep), size=min(precision_sample, len(keep)), replace=False))
+    if attribution_paths and len(cached) == len(stressors) and not rebuild_cache:
+        print("Skipping L·Y, all stressors are in the attribution cache")
+        cache_event("L", "skipped")
+        cache_event("L·Y", "skipped")
+    elif solver == "lu":
+        # solve against the factorized (I - A) so that the dense L is never built
+        with stage("factorize_leontief"):
+            lu = factorize_leontief(exio3_11)
+        if precision == "float32":
+            with stage("precision_reference", columns=precision_sample):
+                reference = (sample, x_diag_columns(exio3_11, keep[sample], lu=lu))
+        cache_event("L·Y", "miss")
+        with stage("calc_x_diag", precision=precision) as record:
+            exio3_11.x_diag = calc_x_diag(exio3_11, lu=lu, dtype=dtype)
+            record["shape"] = list(exio3_11.x_diag.shape)
+    else:
+        L_cache = os.path.join(exio_11_cache, "core", "L") if exio_11_cache else None
+        if L_cache and not rebuild_cache and os.path.exists(L_cache + ".npy"):
+            print("Loading L (exio3_11) from cache")
+            cache_event("L", "hit", os.path.basename(exio_11_cache))
+            with stage("load_L"):
+                exio3_11.L = load_table(L_cache)
+        else:
+            cache_event("L", "miss", os.path.basename(exio_11_cache) if exio_11_cache else None)
+            print("Calculating A (exio3_11)")
+            with stage("calc_A"):
+                exio3_11.A = pymrio.calc_A(exio3_11.Z, exio3_11.x)
+            print("Calculating L (exio3_11)")
+            with stage("calc_L"):
+                exio3_11.L = pymrio.calc_L(exio3_11.A)
+                if L_cache:
+                    save_table(exio3_11.L, L_cache)
+        if precision == "float32":
+            with stage("precision_reference", columns=precision_sample):
+                reference = (sample, x_diag_columns(exio3_11, keep[sample], L=exio3_11.L))
+            with stage("convert_L", precision=precision):
+                L = convert_leontief(exio3_11, dtype)
+        else:
+            L = exio3_11.L
+        cache_event("L·Y", "miss")
+        with stage("calc_x_diag", precision=precision) as record:
+            exio3_11.x_diag = calc_x_diag(exio3_11, L=L, dtype=dtype)
+            record["shape"] = list(exio3_11.x_diag.shape)
+        del L
+
+    if reference is not None:
+        with stage("precision_deviation"):
+            x_reference = reference[1]
+            x_sample = exio3_11.x_diag.to_numpy()[:, keep[sample]]
+            deviations["L·Y"] = max_relative_deviation(x_sample, x_reference)
+
+    # LCI datasets of the impact categories are augmented and their rest of the world regions planned once
+    # from the satellite, pymrio finds the regions in Z or Y, which are not read for the multipliers
+    exio_regions = exio3_19.satellite.get_regions()
+    x_diag_index, x_diag_column_labels = x_diag_labels(exio3_11)
+    consumption = consumption_columns(x_diag_column_labels)
+    lcis = {}
+    for category in impact_categories:
+        if category["lci"] not in lcis:
+            with stage("prepare_lci", lci=category["lci"]) as record:
+                lci, row_countries = prepare_lci(category["lci"], lci_datasets[category["lci"]], exio_regions)
+                lcis[category["lci"]] = (lci, region_expansion(x_diag_index, x_diag_column_labels, row_region_mappings, row_countries))
+                record["shape"] = list(lci.shape)
+        assert category["cf"] in lcis[category["lci"]][0].columns, f"CF column '{category['cf']}' of {category['name']} not found in LCI {category['lci']}"
+        for column in category.get("cf_percentiles", {}).values():
+            assert column in lcis[category["lci"]][0].columns, f"Percentile column '{column}' of {category['name']} not found in LCI {category['lci']}"
+
+    # CFs are drawn from the percentiles in the LCI datasets, the PDF/€ of every draw is a product with the
+    # attribution of the stressor to the producing regions
+    uncertainty = None
+    bands = {}
+    if uncertainty_draws > 0:
+        uncertainty = Uncertainty(uncertainty_draws, list(uncertainty_percentiles), uncertainty_seed)
+        print(f"Drawing {uncertainty_draws} realisations of the CFs from the percentiles:")
+        print(json.dumps({category["name"]: sorted(cf_percentiles(lcis[category["lci"]][0], category["cf"], category.get("cf_percentiles")))
+                          for category in impact_categories}, indent=4, ensure_ascii=False))
+
+    # Stressors are aggregated once per grouping pattern, categories without a pattern use the satellite as is
+    satellites = run_tasks({
+        pattern: lambda pattern=pattern: aggregate_satellites(exio3_11, exio3_19, exiobase_grouping_patterns, pattern,
+                                                              aggregation_paths.get(pattern, (None, None)), rebuild_cache)
+        for pattern in grouping_patterns
+    }, jobs)
+    satellites[None] = (exio3_11.satellite, exio3_19.satellite)
+
+    # The tasks only read the shared systems and LCI data, so they can run concurrently
+    tasks = {"climate": lambda: climate_change(lci_datasets["climate"], exio3_19, exiobase_grouping_patterns, store_cfs, output_dir)}
+    # The stressors of a satellite are calculated together in one pass over L·Y
+    stressors_by_pattern = {}
+    for (pattern, stressor_name), categories in stressors.items():
+        stressors_by_pattern.setdefault(pattern, {})[stressor_name] = categories
+    for pattern, pattern_stressors in stressors_by_pattern.items():
+        pattern_attribution_paths = {stressor_name: attribution_paths[(pattern, stressor_name)] for stressor_name in pattern_stressors if (pattern, stressor_name) in attribution_paths}
+        tasks[("stressors", pattern)] = lambda pattern=pattern, pattern_stressors=pattern_stressors, pattern_attribution_paths=pattern_attribution_paths: calculate_stressors(
+            pattern_stressors, lcis, consumption, exio3_11, *satellites[pattern], store_matrix, store_cfs, output_dir, matrix_dtype, matrix_encoding, sparse_threshold, reference, deviations,
+            pattern_attribution_paths, rebuild_cache, uncertainty, bands)
+    results = run_tasks(tasks, jobs)
+
+    climate_aquatic, climate_terrestrial = results.pop("climate")
+    pdfs = {"climate-aquatic": climate_aquatic, "climate-terrestrial": climate_terrestrial}
+    for stressor_results in results.values():
+        pdfs.update(stressor_results)
+
+    if precision == "float32":
+        report = {
+            "precision": precision,
+            "solver": solver,
+            "sampled_columns": exio3_11.x_diag.columns[keep[sample]].tolist(),
+            "max_relative_deviation": deviations,
+        }
+        with open(f"{output_dir}/precision-report.json", "w") as f:
+            json.dump(report, f, indent=4)
+        print(f"Maximum relative deviation of float32 from float64 on {len(sample)} sampled columns:")
+        print(json.dumps(deviations, indent=4, ensure_ascii=False))
 
-    # Calculate climate change impact
-    climate_aquatic, climate_terrestrial = climate_change(lci_climate, exio3_19, exiobase_grouping_patterns, store_cfs)
+    # Write the results
+    if output_format in ("csv", "both"):
+        with stage("write_csv", files=len(pdfs)):
+            for name, result in pdfs.items():
+                pd.DataFrame(result).to_csv(f"{output_dir}/pdf-{name}.csv", index=True)
+    if output_format in ("parquet", "both"):
+        categories = {"climate-aquatic": "climate", "climate-terrestrial": "climate"}
+        categories.update({category["name"]: category["lci"] for category in impact_categories})
+        metadata = {
+            "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "lc_impact_path": lci_path,
+            "exio_19_path": exio_19_path,
+            "exio_11_path": exio_11_path,
+            "pymrio_version": pymrio.__version__,
+            "solver": solver,
+            "impact_categories": impact_categories,
+        }
+        with stage("write_parquet", files=1):
+            write_parquet(pdfs, categories, f"{output_dir}/pdf-results.parquet", metadata)
+    if bands:
+        with stage("write_bands", files=len(bands)):
+            for name, category_bands in bands.items():
+                category_bands.to_csv(f"{output_dir}/uncertainty-{name}.csv", index=True)
+
+    if cache_dir:
+        report = cache_report()
+        with open(f"{output_dir}/cache-report.json", "w") as f:
+            json.dump(report, f, indent=4, ensure_ascii=False)
+        print("Cached stages:", ", ".join(f"{name} {counts}" for name, counts in report["summary"].items()))
+
+
+def release_system(exio3, results_only=False):
+    """
+    Drop A, L and L·Y calculated by calculate_all from an EXIOBASE system and, unless results_only, the memoised
+    aggregations of its satellite, so that the memory is freed once the system is no longer referenced.
+    """
+    exio3.A = None
+    exio3.L = None
+    vars(exio3).pop("x_diag", None)
+    if not results_only:
+        with AGGREGATION_LOCK:
+            for key in [key for key, (satellite, _) in AGGREGATED_SATELLITES.items() if satellite is exio3.satellite]:
+                del AGGREGATED_SATELLITES[key]
 
-    # Calculate ozone formation impact
-    ozone_nmvoc, ozone_nox = ozone_formation(lci_ozone, exio3_19, exio3_11, row_region_mappings, store_matrix, store_cfs)
-    
-    # Calculate acidification impact
-    acidification_nox, acidification_nh3, acidification_sox = acidification(lci_acidification, exio3_19, exio3_11, row_region_mappings, store_matrix, store_cfs)
-    
-    # Calculate freshwater eutrophication impact
-    freshwater_p_water, freshwater_p_soil = freshwater_eutrophication(lci_freshwater_eutrophication, exio3_19, exio3_11, row_region_mappings, store_matrix, store_cfs)
-    
-    # Calculate marine eutrophication impact
-    marine_n = marine_eutrophication(lci_marine_eutrophication, exio3_19, exio3_11, row_region_mappings, store_matrix, store_cfs)
-    
-    # Calculate water consumption impact
-    water_total = water_consumption(lci_water, exio3_19, exio3_11, row_region_mappings, exiobase_grouping_patterns, store_matrix, store_cfs)
-    
-    # Calculate land use impact
-    land_annual_permanent_impact = land_annual_permanent(lci_land, exio3_11, exio3_19, row_region_mappings, exiobase_grouping_patterns, store_matrix, store_cfs)
-    land_annual_impact = land_annual(lci_land, exio3_11, exio3_19, row_region_mappings, exiobase_grouping_patterns, store_matrix, store_cfs)
-    land_pasture_impact = land_pasture(lci_land, exio3_11, exio3_19, row_region_mappings, exiobase_grouping_patterns, store_matrix, store_cfs)
-    land_forestry_impact = land_forestry(lci_land, exio3_11, exio3_19, row_region_mappings, store_matrix, store_cfs)
-    land_other_impact = land_other(lci_land, exio3_11, exio3_19, row_region_mappings, store_matrix, store_cfs)
 
-    # Write the results
-    pd.DataFrame(climate_aquatic).to_csv("pipeline/output/pdf-climate-aquatic.csv", index=True)
-    pd.DataFrame(climate_terrestrial).to_csv("pipeline/output/pdf-climate-terrestrial.csv", index=True)
-    pd.DataFrame(ozone_nmvoc).to_csv("pipeline/output/pdf-ozone-nmvoc.csv", index=True)
-    pd.DataFrame(ozone_nox).to_csv("pipeline/output/pdf-ozone-nox.csv", index=True)
-    pd.DataFrame(acidification_nox).to_csv("pipeline/output/pdf-acidification-nox.csv", index=True)
-    pd.DataFrame(acidification_nh3).to_csv("pipeline/output/pdf-acidification-nh3.csv", index=True)
-    pd.DataFrame(acidification_sox).to_csv("pipeline/output/pdf-acidification-sox.csv", index=True)
-    pd.DataFrame(freshwater_p_water).to_csv("pipeline/output/pdf-freshwater-eutrophication-water.csv", index=True)
-    pd.DataFrame(freshwater_p_soil).to_csv("pipeline/output/pdf-freshwater-eutrophication-soil.csv", index=True)
-    pd.DataFrame(marine_n).to_csv("pipeline/output/pdf-marine-eutrophication.csv", index=True)
-    pd.DataFrame(water_total).to_csv("pipeline/output/pdf-water-consumption.csv", index=True)
-    pd.DataFrame(land_annual_permanent_impact).to_csv("pipeline/output/pdf-land-annual-permanent-crops.csv", index=True)
-    pd.DataFrame(land_annual_impact).to_csv("pipeline/output/pdf-land-annual-crops.csv", index=True)
-    pd.DataFrame(land_pasture_impact).to_csv("pipeline/output/pdf-land-pasture.csv", index=True)
-    pd.DataFrame(land_forestry_impact).to_csv("pipeline/output/pdf-land-forestry.csv", index=True)
-    pd.DataFrame(land_other_impact).to_csv("pipeline/output/pdf-land-other.csv", index=True)
+def calculate_years(lci_path, exio_paths, years, row_region_mappings, exiobase_grouping_patterns, impact_categories, output_dir="pipeline/output", cache_dir="pipeline/cache", rebuild_cache=False, full_parse=False, **options):
+    """
+    Run calculate_all for a list of (share year, multiplier year) pairs, where the share year is the table
+    the shares of the stressors are calculated from (exio_11_path of a single run) and the multiplier year the
+    table of the multipliers (exio_19_path). exio_paths maps the years to their EXIOBASE zips. The results of
+    each pair are written to output_dir/<share year>-<multiplier year>. The LCI datasets are loaded once and only
+    the systems of the current pair are kept, a system is reused if the next pair needs it as well, so at most
+    two systems and the L·Y of one are in memory. options are passed on to calculate_all.
+    """
+    CACHE_EVENTS.clear()
+    with stage("load_lci"):
+        lci_datasets = load_lci(lci_path, cache_dir, rebuild_cache)
+    # a year is read with the tables of all its roles, so that it can be kept for the next pair
+    manifests = {}
+    if not full_parse:
+        roles = {}
+        for share_year, multiplier_year in years:
+            roles.setdefault(share_year, set()).add("share")
+            roles.setdefault(multiplier_year, set()).add("multiplier")
+        manifests = {year: exiobase_manifest(year_roles, exiobase_grouping_patterns, impact_categories) for year, year_roles in roles.items()}
+    loaded = {}
+    for share_year, multiplier_year in years:
+        label = f"{share_year}-{multiplier_year}"
+        print(f"Calculating PDF/€ of {label} (shares of {share_year}, multipliers of {multiplier_year})")
+        for year in [year for year in loaded if year not in (share_year, multiplier_year)]:
+            release_system(loaded.pop(year)[0])
+        for year in (share_year, multiplier_year):
+            if year not in loaded:
+                with stage("load_exiobase", path=exio_paths[year]):
+                    loaded[year] = load_exiobase(exio_paths[year], cache_dir, rebuild_cache, manifests.get(year))
+        calculate_all(lci_path, exio_paths[multiplier_year], exio_paths[share_year], row_region_mappings, exiobase_grouping_patterns, impact_categories,
+                      cache_dir=cache_dir, rebuild_cache=rebuild_cache, output_dir=os.path.join(output_dir, label), full_parse=full_parse, lci_datasets=lci_datasets,
+                      systems={exio_paths[year]: loaded[year] for year in (share_year, multiplier_year)}, **options)
+        # L and L·Y are calculated again if the share year is needed by another pair
+        release_system(loaded[share_year][0], results_only=True)
+        # the cache report of each pair has the events from its loading on
+        CACHE_EVENTS.clear()
+    for exio3, _ in loaded.values():
+        release_system(exio3)
+
+
+# PDF/€ factors of the results of calculate_all, see load_factors
+Factors = namedtuple("Factors", ["values", "categories", "index"])
+
+
+def load_factors(output_dir="pipeline/output", categories=None):
+    """
+    Load the PDF/€ results of calculate_all in output_dir into one (categories, region-sectors) array, from
+    pdf-results.parquet if it exists and otherwise from the pdf-<name>.csv files. categories selects and orders
+    the results by name (default all of them, sorted). Region-sectors without a factor in a category (the rest of
+    the world regions of the regionalised categories) get 0, as do missing values.
+    """
+    parquet_path = os.path.join(output_dir, "pdf-results.parquet")
+    if os.path.exists(parquet_path):
+        table = pd.read_parquet(parquet_path, columns=["flow", "region", "sector", "value"])
+        results = table.set_index(["region", "sector", "flow"])["value"].unstack("flow")
+    else:
+        results = {}
+        for path in sorted(glob.glob(os.path.join(output_dir, "pdf-*.csv"))):
+            result = pd.read_csv(path, index_col=[0, 1]).iloc[:, 0]
+            results[os.path.basename(path)[len("pdf-"):-len(".csv")]] = result.rename_axis(["region", "sector"])
+        assert results, f"No results found in {output_dir}"
+        results = pd.DataFrame(results)
+    categories = sorted(results.columns) if categories is None else list(categories)
+    values = np.ascontiguousarray(results[categories].fillna(0).to_numpy(dtype=float).T)
+    return Factors(values=values, categories=categories, index=results.index)
+
+
+def score_baskets(factors, baskets):
+    """
+    PDF of consumer baskets with the factors from load_factors. baskets is a DataFrame with the columns basket,
+    region, sector and value (€ spent), one row per item, or a (baskets, region-sectors) array or scipy.sparse
+    matrix in the order of factors.index. All baskets are scored with one (sparse) matrix product.
+    Returns a DataFrame of the PDF of each basket by category and their total.
+    """
+    import scipy.sparse
+    if isinstance(baskets, pd.DataFrame):
+        positions = factors.index.get_indexer(pd.MultiIndex.from_frame(baskets[["region", "sector"]]))
+        unknown = positions < 0
+        if unknown.any():
+            examples = baskets.loc[unknown, ["region", "sector"]].drop_duplicates().head(5).to_records(index=False).tolist()
+            raise ValueError(f"{unknown.sum()} basket items have a region-sector without factors, e.g. {examples}")
+        codes, basket_ids = pd.factorize(baskets["basket"])
+        # items of the same basket and region-sector are summed
+        spend = scipy.sparse.csr_matrix((baskets["value"].to_numpy(dtype=float), (codes, positions)), shape=(len(basket_ids), len(factors.index)))
+        index = pd.Index(basket_ids, name="basket")
+    else:
+        spend = baskets
+        index = pd.RangeIndex(spend.shape[0], name="basket")
+    scores = np.asarray(spend @ factors.values.T)
+    result = pd.DataFrame(scores, index=index, columns=factors.categories)
+    result["total"] = scores.sum(axis=1)
+    return result
 
 
 def main():
     parser = argparse.ArgumentParser(description="Calculate PDF (Probability of Disappearance of Fractions) values for various environmental impact categories.")
     parser.add_argument("json_file", type=str, help="Path to the JSON file containing configuration parameters.")
     parser.add_argument("--store-matrix", action="store_true", 
-                        help="Store dr_f matrices as pickle files to output/matrices directory. "
+                        help="Store dr_f matrices as memory-mappable .npy files with a JSON index to output/matrices directory. "
                              "These matrices contain the regional distribution of environmental impacts "
                              "per euro spent. Climate impact matrices are not stored as they are not "
                              "regionally distributed.")
+    parser.add_argument("--matrix-dtype", choices=["float64", "float32"], default="float64",
+                        help="Data type of the stored matrices (default float64). float32 halves their size.")
+    parser.add_argument("--matrix-encoding", choices=["dense", "sparse"], default="dense",
+                        help="'dense' stores a matrix as one column-major .npy file (default), 'sparse' stores only "
+                             "its non-zero values as CSC arrays, which is smaller as most values of dr_f are zero.")
+    parser.add_argument("--sparse-threshold", type=float, default=0.5,
+                        help="Stressors that are non-zero in a smaller share of the producing region-sectors than this "
+                             "(default 0.5) are calculated from those rows only. 0 disables it.")
+    parser.add_argument("--precision", choices=["float64", "float32"], default="float64",
+                        help="Precision of L·Y, dr_s, dr_u and dr_f (default float64). float32 halves their memory and "
+                             "writes the maximum relative deviation from float64 on sampled columns to precision-report.json.")
     parser.add_argument("--store-cfs", action="store_true",
                         help="Store characterization factors as CSV files to output/cfs directory. "
                              "These files contain the CF values used in calculations with country codes "
                              "and augmentation source information for transparency.")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always read the LC-IMPACT workbooks, parse the EXIOBASE zips and calculate L instead of using the cache in pipeline/cache.")
+    parser.add_argument("--rebuild-cache", action="store_true",
+                        help="Compile the LC-IMPACT workbooks, parse the EXIOBASE zips and calculate L again and replace the cached versions in pipeline/cache.")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of impact categories calculated concurrently (default 1).")
+    parser.add_argument("--output-dir", type=str, default="pipeline/output",
+                        help="Directory of the output files (default pipeline/output).")
+    parser.add_argument("--output-format", choices=["csv", "parquet", "both"], default="csv",
+                        help="'csv' writes a pdf-<name>.csv file per result (default), 'parquet' writes all results "
+                             "to one pdf-results.parquet table with the run metadata, 'both' writes both. "
+                             "Parquet output requires pyarrow.")
+    parser.add_argument("--solver", choices=["inverse", "lu"], default="inverse",
+                        help="How the Leontief model of the 2011 table is solved. 'inverse' calculates the "
+                             "Leontief inverse L (default), 'lu' LU factorizes (I - A) and solves against the "
+                             "final demand without building L, which needs less memory.")
+    parser.add_argument("--uncertainty-draws", type=int, default=0,
+                        help="Draw this many realisations of the CFs from the percentiles in the LC-IMPACT workbooks and "
+                             "write percentiles of the PDF/€ over the draws to uncertainty-<name>.csv (default 0, off).")
+    parser.add_argument("--uncertainty-percentiles", type=str, default="2.5,50,97.5",
+                        help="Comma separated percentiles written by --uncertainty-draws (default 2.5,50,97.5).")
+    parser.add_argument("--uncertainty-seed", type=int, default=0,
+                        help="Seed of the CF draws (default 0), runs with the same seed draw the same CFs.")
+    parser.add_argument("--years", type=str, default=None,
+                        help="Comma separated (share year):(multiplier year) pairs, e.g. 2011:2019,2012:2020, calculated "
+                             "one after the other with the LCI datasets loaded once. The zips of the years are read from "
+                             "exio_paths in the JSON file (exio_11_path and exio_19_path are the years 2011 and 2019). "
+                             "Results go to <output dir>/<share year>-<multiplier year>.")
+    parser.add_argument("--full-parse", action="store_true",
+                        help="Parse the complete EXIOBASE zips with pymrio instead of reading only the tables and "
+                             "stressors used by the impact categories and grouping patterns.")
+    parser.add_argument("--run-report", type=str, default=None,
+                        help="Record wall and CPU time, peak RSS and result shapes of every stage of the run and "
+                             "write them to this JSON file.")
+    parser.add_argument("--profile-dir", type=str, default=None,
+                        help="Profile every stage with cProfile to <nr>-<stage>.prof files in this directory.")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="Trace the peak of the memory allocated by Python during every stage with tracemalloc. "
+                             "Slows down the run.")
     
     # Parse the arguments
     args = parser.parse_args()
     json_file = args.json_file
     store_matrix = args.store_matrix
     store_cfs = args.store_cfs
+    solver = args.solver
+    cache_dir = None if args.no_cache else "pipeline/cache"
+    rebuild_cache = args.rebuild_cache
+    jobs = args.jobs
+    output_dir = args.output_dir
+    output_format = args.output_format
+    matrix_dtype = args.matrix_dtype
+    matrix_encoding = args.matrix_encoding
+    sparse_threshold = args.sparse_threshold
+    precision = args.precision
+    run_report = args.run_report
+    uncertainty_percentiles = [float(percentile) for percentile in args.uncertainty_percentiles.split(",")]
+
+    if run_report or args.profile_dir or args.tracemalloc:
+        enable_instrumentation(args.profile_dir, args.tracemalloc)
 
     try:
         # Open and read the JSON file
@@ -1243,7 +2177,22 @@ def main():
         print("Successfully parsed JSON file:")
         print(json.dumps(data, indent=4))  # Pretty-print JSON
 
-        calculate_all(data['lc_impact_path'], data['exio_19_path'], data['exio_11_path'], data['row_region_mappings'], data['exiobase_grouping_patterns'], store_matrix, store_cfs)
+        CACHE_EVENTS.clear()
+        if args.years:
+            exio_paths = {"2011": data['exio_11_path'], "2019": data['exio_19_path'], **data.get('exio_paths', {})}
+            years = [tuple(pair.split(":")) for pair in args.years.split(",")]
+            calculate_years(data['lc_impact_path'], exio_paths, years, data['row_region_mappings'], data['exiobase_grouping_patterns'], data['impact_categories'], output_dir, cache_dir, rebuild_cache, args.full_parse,
+                            store_matrix=store_matrix, store_cfs=store_cfs, solver=solver, jobs=jobs, output_format=output_format, matrix_dtype=matrix_dtype, matrix_encoding=matrix_encoding,
+                            sparse_threshold=sparse_threshold, precision=precision, uncertainty_draws=args.uncertainty_draws, uncertainty_percentiles=uncertainty_percentiles, uncertainty_seed=args.uncertainty_seed)
+        else:
+            calculate_all(data['lc_impact_path'], data['exio_19_path'], data['exio_11_path'], data['row_region_mappings'], data['exiobase_grouping_patterns'], data['impact_categories'], store_matrix, store_cfs, solver, cache_dir, rebuild_cache, jobs, output_dir, output_format, matrix_dtype, matrix_encoding, sparse_threshold, precision,
+                          uncertainty_draws=args.uncertainty_draws, uncertainty_percentiles=uncertainty_percentiles, uncertainty_seed=args.uncertainty_seed, full_parse=args.full_parse)
+        if run_report:
+            write_run_report(run_report, {
+                "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "arguments": vars(args),
+                "pymrio_version": pymrio.__version__,
+            })
     except FileNotFoundError:
         print(f"Error: File '{json_file}' not found.")
     except json.JSONDecodeError as e:
@@ -0,0 +1,313 @@
+"""
+Local HTTP/JSON service for looking up the PDF/€ factors of a run of calculate-all.py by consumption region,
+sector and category.
+
+The results in the output directory are compiled once into a binary index (factor-index.npy with the factors
+of all categories and factor-index.json with the labels), which the service memory-maps. The results are
+watched and the index is compiled and swapped in again when a new run lands. Only the standard library,
+numpy and (for compiling the index) the dependencies of calculate-all.py are needed.
+
+Endpoints:
+    GET  /factor?region=FI&sector=...&category=...  factor of one region-sector and category, or of all
+                                                    categories without category
+    POST /factors {"queries": [{"region": ..., "sector": ..., "category": ...}, ...]}
+                                                    factors of a batch of lookups, null if unknown, 400 if
+                                                    a lookup has no region or sector
+    POST /reload                                    compile and load the index again, 500 if that fails
+    GET  /metrics                                   request counts and latency percentiles per endpoint
+    GET  /health                                    the loaded index
+"""
+import argparse
+import collections
+import datetime
+import glob
+import importlib.util
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+INDEX_NAME = "factor-index"
+
+# factors of a compiled index, values (categories, region-sectors) are memory-mapped
+FactorIndex = namedtuple("FactorIndex", ["values", "categories", "positions", "signature", "created", "generation"])
+
+
+def load_pipeline(path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "calculate-all.py")):
+    spec = importlib.util.spec_from_file_location("calculate_all", path)
+    pipeline = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(pipeline)
+    return pipeline
+
+
+def results_signature(output_dir):
+    """
+    Name, size and modification time of the result files in output_dir, which change with every run.
+    """
+    paths = sorted(glob.glob(os.path.join(output_dir, "pdf-*.csv")) + glob.glob(os.path.join(output_dir, "pdf-results.parquet")))
+    signature = []
+    for path in paths:
+        stat = os.stat(path)
+        signature.append([os.path.basename(path), stat.st_size, stat.st_mtime_ns])
+    return signature
+
+
+def compile_index(output_dir):
+    """
+    Compile the results in output_dir to factor-index.npy (factors of all categories, float64) and
+    factor-index.json (categories, region-sectors and the signature of the results they were compiled from).
+    Files are written under temporary names and moved in place, the .json last.
+    """
+    signature = results_signature(output_dir)
+    factors = load_pipeline().load_factors(output_dir)
+    print(f"Compiling {len(factors.categories)} categories of {len(factors.index)} region-sectors to {os.path.join(output_dir, INDEX_NAME)}")
+    path = os.path.join(output_dir, INDEX_NAME)
+    tmp_path = f"{path}.npy.tmp-{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        np.save(f, factors.values)
+    os.replace(tmp_path, path + ".npy")
+    meta = {
+        "categories": factors.categories,
+        "index": [list(key) for key in factors.index],
+        "signature": signature,
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+    tmp_path = f"{path}.json.tmp-{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp_path, path + ".json")
+
+
+def open_index(output_dir, generation=0, compile_stale=True):
+    """
+    Memory-map the compiled index of output_dir. With compile_stale the index is compiled first if it is missing
+    or was compiled from other results.
+    """
+    path = os.path.join(output_dir, INDEX_NAME)
+    meta = None
+    if os.path.exists(path + ".json"):
+        with open(path + ".json", "r") as f:
+            meta = json.load(f)
+    if compile_stale and (meta is None or meta["signature"] != results_signature(output_dir)):
+        compile_index(output_dir)
+        with open(path + ".json", "r") as f:
+            meta = json.load(f)
+    values = np.load(path + ".npy", mmap_mode="r")
+    positions = {(region, sector): i for i, (region, sector) in enumerate(meta["index"])}
+    return FactorIndex(values=values, categories={category: i for i, category in enumerate(meta["categories"])},
+                       positions=positions, signature=meta["signature"], created=meta["created"], generation=generation)
+
+
+def lookup(index, region, sector, category=None):
+    """
+    Factor of a region-sector in a category, or the factors of all categories by category without category.
+    None if the region-sector or category is unknown.
+    """
+    position = index.positions.get((region, sector))
+    if position is None:
+        return None
+    if category is None:
+        return {name: float(index.values[row, position]) for name, row in index.categories.items()}
+    row = index.categories.get(category)
+    return None if row is None else float(index.values[row, position])
+
+
+class Metrics:
+    """
+    Request counts and the latencies of the last window requests of each endpoint.
+    """
+
+    def __init__(self, window=10000):
+        self.window = window
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.errors = collections.Counter()
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=self.window))
+
+    def record(self, endpoint, seconds, error=False):
+        with self.lock:
+            self.counts[endpoint] += 1
+            if error:
+                self.errors[endpoint] += 1
+            self.latencies[endpoint].append(seconds)
+
+    def report(self):
+        with self.lock:
+            report = {}
+            for endpoint, count in self.counts.items():
+                latencies = np.array(self.latencies[endpoint]) * 1000
+                report[endpoint] = {
+                    "requests": count,
+                    "errors": self.errors[endpoint],
+                    "latency_ms": {
+                        "p50": float(np.percentile(latencies, 50)),
+                        "p95": float(np.percentile(latencies, 95)),
+                        "p99": float(np.percentile(latencies, 99)),
+                        "max": float(latencies.max()),
+                    },
+                }
+            return report
+
+
+class FactorService(ThreadingHTTPServer):
+    """
+    HTTP server holding the loaded index, which reload swaps for a new one. Requests keep the index they started
+    with, the memory-mapped arrays of a replaced index stay valid until they are no longer referenced.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, output_dir):
+        super().__init__(address, FactorRequestHandler)
+        self.output_dir = output_dir
+        self.metrics = Metrics()
+        self.reload_lock = threading.Lock()
+        self.index = open_index(output_dir)
+
+    def reload(self):
+        with self.reload_lock:
+            self.index = open_index(self.output_dir, self.index.generation + 1)
+            print(f"Loaded factor index generation {self.index.generation} ({len(self.index.categories)} categories)")
+        return self.index
+
+    def watch(self, interval):
+        """
+        Reload the index when the results change. A change is picked up once the results have been the same for
+        two checks, so that a run that is still writing its results is not compiled.
+        """
+        previous = None
+        while True:
+            time.sleep(interval)
+            try:
+                signature = results_signature(self.output_dir)
+                if signature != self.index.signature and signature == previous:
+                    self.reload()
+                previous = signature
+            except Exception as e:
+                print(f"Reloading the factor index failed: {e}")
+
+
+class FactorRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/factor":
+            self.respond(url.path, self.get_factor, parse_qs(url.query))
+        elif url.path == "/metrics":
+            self.respond(url.path, lambda: self.server.metrics.report())
+        elif url.path == "/health":
+            self.respond(url.path, self.health)
+        else:
+            self.respond(url.path, None)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path == "/factors":
+            self.respond(url.path, self.get_factors)
+        elif url.path == "/reload":
+            self.respond(url.path, self.reload_index)
+        else:
+            self.respond(url.path, None)
+
+    def get_factor(self, query):
+        index = self.server.index
+        category = query.get("category", [None])[0]
+        try:
+            region, sector = query["region"][0], query["sector"][0]
+        except KeyError:
+            raise ValueError("region and sector are required")
+        value = lookup(index, region, sector, category)
+        if value is None:
+            raise KeyError(f"No factor for region {region}, sector {sector}" + (f" and category {category}" if category else ""))
+        return {"region": region, "sector": sector, "category": category, "value": value} if category else \
+            {"region": region, "sector": sector, "values": value}
+
+    def get_factors(self):
+        index = self.server.index
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length))
+        queries = body.get("queries") if isinstance(body, dict) else None
+        if not isinstance(queries, list):
+            raise ValueError("queries must be a list of lookups")
+        # the whole batch is rejected if one lookup is malformed, unknown lookups are null
+        for i, query in enumerate(queries):
+            if not isinstance(query, dict) or not isinstance(query.get("region"), str) or not isinstance(query.get("sector"), str):
+                raise ValueError(f"query {i} must be an object with region and sector")
+            if not isinstance(query.get("category"), (str, type(None))):
+                raise ValueError(f"category of query {i} must be a string")
+        return {"values": [lookup(index, query["region"], query["sector"], query.get("category")) for query in queries]}
+
+    def reload_index(self):
+        try:
+            self.server.reload()
+        except Exception as e:
+            # any failure to compile or load the results is an error of the service, not of the request
+            raise RuntimeError(f"Reloading the factor index failed: {e!r}") from e
+        return self.health()
+
+    def health(self):
+        index = self.server.index
+        return {"generation": index.generation, "created": index.created, "categories": list(index.categories),
+                "region_sectors": len(index.positions)}
+
+    def respond(self, endpoint, handler, *args):
+        start = time.perf_counter()
+        status = 200
+        try:
+            if handler is None:
+                status, body = 404, {"error": f"Unknown endpoint {endpoint}"}
+            else:
+                body = handler(*args)
+        except KeyError as e:
+            status, body = 404, {"error": str(e.args[0]) if e.args else "Not found"}
+        except (ValueError, TypeError) as e:
+            status, body = 400, {"error": str(e)}
+        except Exception as e:
+            # for example a failed /reload, the index that was loaded before is still served
+            print(f"{endpoint} failed: {e}")
+            status, body = 500, {"error": str(e)}
+        data = json.dumps(body, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.metrics.record(endpoint if handler is not None else "unknown", time.perf_counter() - start, status != 200)
+
+    def log_message(self, format, *args):
+        # latencies are in /metrics, logging every request would dominate them
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the PDF/€ factors of a calculate-all.py run over HTTP/JSON.")
+    parser.add_argument("--output-dir", type=str, default="pipeline/output", help="Output directory of calculate-all.py (default pipeline/output).")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on (default 127.0.0.1).")
+    parser.add_argument("--port", type=int, default=8050, help="Port to listen on (default 8050).")
+    parser.add_argument("--poll-interval", type=float, default=5,
+                        help="Seconds between checks of the results for a new run (default 5). 0 disables reloading, POST /reload still reloads.")
+    parser.add_argument("--compile-only", action="store_true", help="Compile the index of the output directory and exit.")
+    args = parser.parse_args()
+
+    if args.compile_only:
+        compile_index(args.output_dir)
+        return
+
+    server = FactorService((args.host, args.port), args.output_dir)
+    if args.poll_interval > 0:
+        threading.Thread(target=server.watch, args=(args.poll_interval,), daemon=True).start()
+    print(f"Serving {len(server.index.categories)} categories of {len(server.index.positions)} region-sectors on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,16 @@
+import importlib.util
+import os
+
+import pytest
+
+
+@pytest.fixture(scope="session")
+def pipeline():
+    """
+    calculate-all.py loaded as a module.
+    """
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "calculate-all.py")
+    spec = importlib.util.spec_from_file_location("calculate_all", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,58 @@
+import os
+import zipfile
+
+import numpy as np
+import pandas as pd
+import pymrio
+
+
+def exiobase_zip(tmp_path, regions, sectors=("Wheat", "Cattle")):
+    """
+    Zip of a small system in the layout of the EXIOBASE 3 zips, with the given region codes.
+    """
+    rng = np.random.default_rng(0)
+    index = pd.MultiIndex.from_product([regions, sectors], names=["region", "sector"])
+    Z = pd.DataFrame(rng.random((len(index), len(index))), index=index, columns=index)
+    Y = pd.DataFrame(rng.random((len(index), len(regions))) * 10,
+                     index=index, columns=pd.MultiIndex.from_product([regions, ["Households"]], names=["region", "category"]))
+    x = pd.DataFrame({"indout": Z.sum(axis=1) + Y.sum(axis=1)})
+    unit = pd.DataFrame({"unit": "M.EUR"}, index=index)
+    stressors = pd.Index(["CO2 - combustion - air", "CH4 - agriculture - air", "Forest area - Forestry"], name="stressor")
+    F = pd.DataFrame(rng.random((len(stressors), len(index))), index=stressors, columns=index)
+    satellite = pymrio.Extension("satellite", F=F, M=F / x["indout"].to_numpy(), unit=pd.DataFrame({"unit": "kg"}, index=stressors))
+    system = pymrio.IOSystem(Z=Z, Y=Y, x=x, unit=unit, name="test")
+    system.satellite = satellite
+
+    folder = tmp_path / "IOT_2011_pxp"
+    system.save_all(folder)
+    path = tmp_path / "IOT_2011_pxp.zip"
+    with zipfile.ZipFile(path, "w") as zf:
+        for root, _, files in os.walk(folder):
+            for name in files:
+                zf.write(os.path.join(root, name), os.path.relpath(os.path.join(root, name), tmp_path))
+    return str(path)
+
+
+def test_read_exiobase_zip_renames_iso3_regions(pipeline, tmp_path):
+    path = exiobase_zip(tmp_path, ["AUT", "FIN", "WWE"])
+    manifest = {"core": ["Y", "Z", "unit", "x"], "satellite": ["F", "M", "unit"], "stressors": ["CO2", "Forest area - Forestry$"]}
+
+    exio3 = pipeline.read_exiobase_zip(path, manifest)
+
+    assert list(exio3.satellite.get_regions()) == ["AT", "FI", "WE"]
+    assert list(exio3.x.index.get_level_values("region").unique()) == ["AT", "FI", "WE"]
+    assert list(exio3.Y.columns.get_level_values("region").unique()) == ["AT", "FI", "WE"]
+    assert list(exio3.satellite.F.index) == ["CO2 - combustion - air", "Forest area - Forestry"]
+
+
+def test_read_exiobase_zip_matches_parse_exiobase3(pipeline, tmp_path):
+    path = exiobase_zip(tmp_path, ["AUT", "FIN", "WWE"])
+    manifest = {"core": ["Y", "Z", "unit", "x"], "satellite": ["F", "M", "unit"], "stressors": ["CO2", "CH4", "Forest"]}
+
+    exio3 = pipeline.read_exiobase_zip(path, manifest)
+    parsed = pymrio.parse_exiobase3(path)
+
+    for name in ["Z", "Y", "x"]:
+        pd.testing.assert_frame_equal(getattr(exio3, name), getattr(parsed, name))
+    for name in ["F", "M"]:
+        pd.testing.assert_frame_equal(getattr(exio3.satellite, name), getattr(parsed.satellite, name))
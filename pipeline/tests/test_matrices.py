@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+import pymrio
+import pytest
+
+
+@pytest.fixture
+def stressor(pipeline):
+    """
+    L·Y_diag, intensity and multipliers of a stressor in a small system with a rest of the world region and a
+    consumption region-sector without final demand, and the region_expansion of the system.
+    """
+    rng = np.random.default_rng(0)
+    regions = ["FI", "SE"] + list(pipeline.ROW_REGIONS)
+    index = pd.MultiIndex.from_product([regions, ["Wheat", "Cattle", "Forestry"]], names=["region", "sector"])
+    x_diag = pd.DataFrame(rng.random((len(index), len(index))), index=index, columns=index)
+    x_diag[("SE", "Cattle")] = 0
+    s = np.zeros(len(index))
+    s[[2, 5, 8, 14]] = [2.0, 1.5, 3.0, 0.5]
+    M = pd.DataFrame([rng.random(len(index))], index=["Forest area - Forestry"], columns=index)
+    row_region_mappings = {mapping: {} for mapping in pipeline.ROW_REGION_MAPPINGS}
+    row_region_mappings["row_eu"] = {"NO": "Norway", "IS": "Iceland"}
+    expansion = pipeline.region_expansion(index, index, row_region_mappings, ["NO", "IS"])
+    return x_diag, s, M, expansion
+
+
+def test_sparse_and_dense_dr_f_are_stored_the_same(pipeline, stressor, tmp_path):
+    x_diag, s, M, expansion = stressor
+    satellite = pymrio.Extension("satellite", M=M)
+    dense = pipeline.dr_f(satellite, pipeline.dr_u(pipeline.dr_s(x_diag * s[:, np.newaxis]), expansion), "Forest area - Forestry")
+    m = M.drop(columns=list(pipeline.ROW_REGIONS), level=0).to_numpy()[0]
+    sparse = pipeline.sparse_dr_f(x_diag.to_numpy(), s, m, np.flatnonzero(s), expansion)
+    assert dense[("SE", "Cattle")].isna().all()
+
+    stored = []
+    for name, dr_f in [("dense", dense), ("sparse", sparse)]:
+        for encoding in ["dense", "sparse"]:
+            path = str(tmp_path / f"{name}-{encoding}")
+            pipeline.save_matrix(dr_f, path, encoding=encoding)
+            matrix = pipeline.load_matrix(path)
+            stored.append(matrix.sparse.to_dense() if encoding == "sparse" else matrix)
+    for matrix in stored:
+        assert matrix.index.equals(dense.index) and matrix.columns.equals(dense.columns)
+        np.testing.assert_allclose(matrix.to_numpy(), dense.to_numpy(), rtol=1e-12, atol=0, equal_nan=True)
@@ -0,0 +1,75 @@
+import importlib.util
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def service(tmp_path):
+    """
+    query-service.py serving an index of two region-sectors and two categories compiled into tmp_path.
+    """
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "query-service.py")
+    spec = importlib.util.spec_from_file_location("query_service", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    np.save(tmp_path / "factor-index.npy", np.array([[1.0, 2.0], [3.0, 4.0]]))
+    meta = {"categories": ["land", "water"], "index": [["FI", "Wheat"], ["SE", "Wheat"]],
+            "signature": module.results_signature(str(tmp_path)), "created": "2024-01-01T00:00:00+00:00"}
+    (tmp_path / "factor-index.json").write_text(json.dumps(meta))
+    server = module.FactorService(("127.0.0.1", 0), str(tmp_path))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server, f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def post(url, body):
+    request = urllib.request.Request(url, data=json.dumps(body).encode(), method="POST")
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as e:
+        return e.code, json.load(e)
+
+
+def errors(server, endpoint):
+    # requests are recorded after their response is sent
+    for _ in range(100):
+        report = server.metrics.report()
+        if endpoint in report:
+            return report[endpoint]["errors"]
+        time.sleep(0.01)
+
+
+def test_factors(service):
+    server, url = service
+    status, body = post(url + "/factors", {"queries": [{"region": "SE", "sector": "Wheat", "category": "land"},
+                                                       {"region": "NO", "sector": "Wheat"}]})
+    assert status == 200 and body == {"values": [2.0, None]}
+
+
+@pytest.mark.parametrize("query", [{"region": "FI"}, {"sector": "Wheat"}, "FI", None, {"region": "FI", "sector": 1}])
+def test_malformed_factors_query(service, query):
+    server, url = service
+    status, body = post(url + "/factors", {"queries": [{"region": "FI", "sector": "Wheat"}, query]})
+    assert status == 400 and "query 1" in body["error"]
+    assert errors(server, "/factors") == 1
+
+
+def test_failed_reload(service, tmp_path):
+    server, url = service
+    (tmp_path / "factor-index.npy").unlink()
+    (tmp_path / "pdf-land.csv").write_text("not a result\n")
+    status, body = post(url + "/reload", {})
+    assert status == 500 and "Reloading the factor index failed" in body["error"]
+    assert errors(server, "/reload") == 1
+    assert server.index.generation == 0